@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# the end-to-end benchmarks of the sync, against mrbus.replay and a scratch
+# database (it drops and creates the tables, so never point it to the real
+# one):
+#
+#     $ python -m mrbus.replay record fixtures/
+#     $ PGDATABASE=mrbus_bench python -m mrbus.bench sync fixtures/ --latency-sec=0.05
+#
+# and the memory of the records of a sweep, which needs neither:
+#
+#     $ python -m mrbus.bench records --route-n=1000
+#
+# and the cold start of the entry points:
+#
+#     $ python -m mrbus.bench imports
+#
+
+import os
+import sys
+import json
+import resource
+import subprocess
+from time import time
+from mrbus.util import debug
+
+def _get_peak_rss_mb():
+
+    # VmHWM is the peak since the last _reset_peak_rss, on Linux
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])/1024.
+    except IOError:
+        pass
+
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+def _reset_peak_rss():
+    # so the peak is of a phase; Linux >= 4.0 only, or it's of the process
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        pass
+
+def _ensure_scratch_db():
+    if not os.environ.get('PGDATABASE'):
+        raise ValueError(
+            'set PGDATABASE to a scratch database; the tables will be dropped'
+        )
+
+def _count_routes():
+    from mrbus.conn import db
+    with db as cur:
+        cur.execute('select count(*) from route where on_index = true')
+        return cur.fetchone()[0]
+
+def _get_db_sec():
+    from mrbus import metrics
+    return metrics.get_histogram_sum('mrbus_db_statement_seconds')
+
+def _run_phase(name, func, server):
+
+    request_n = server.get_stats().get('request_n', 0)
+    db_sec = _get_db_sec()
+    _reset_peak_rss()
+
+    start_ts = time()
+    func()
+    sec = time()-start_ts
+
+    request_n = server.get_stats().get('request_n', 0)-request_n
+    db_sec = _get_db_sec()-db_sec
+
+    return {
+        'name'       : name,
+        'sec'        : sec,
+        'request_n'  : request_n,
+        'db_sec'     : db_sec,
+        'peak_rss_mb': _get_peak_rss_mb()
+    }
+
+def _print_report(route_n, phase_ds, server):
+
+    from mrbus import metrics
+
+    print '{:<24} {:>8} {:>10} {:>10} {:>8} {:>8}'.format(
+        'phase', 'sec', 'routes/s', 'reqs/s', 'db sec', 'peak MB'
+    )
+    for d in phase_ds:
+        print '{:<24} {:>8.3f} {:>10.1f} {:>10.1f} {:>8.3f} {:>8.1f}'.format(
+            d['name'],
+            d['sec'],
+            route_n/d['sec'],
+            d['request_n']/d['sec'],
+            d['db_sec'],
+            d['peak_rss_mb']
+        )
+
+    print
+    print 'routes      : {}'.format(route_n)
+    print 'server      : {}'.format(server.get_stats())
+    print 'peak rss    : {:.1f} MB'.format(_get_peak_rss_mb())
+    print
+    print metrics.render_prometheus()
+
+def sync(
+    fixture_dir, latency_sec=0.05, jitter_sec=0.0, error_rate=0.0,
+    reset_rate=0.0, engine='pool', chunk_size=100, parse_processes=0
+):
+
+    # engine: pool or green
+    # parse_processes: parse in a process pool of this size, see
+    #                  mrbus.gov.set_parse_processes
+
+    _ensure_scratch_db()
+
+    pool = None
+    if engine == 'green':
+        # patch before the others are imported, or mrbus.replay binds the
+        # unpatched sleep and threading, and its latency blocks the loop
+        from mrbus.green import Engine
+        pool = Engine()
+
+    from mrbus import model, op, gov, metrics
+    from mrbus.replay import ReplayServer
+    gov.set_parse_processes(parse_processes)
+
+    server = ReplayServer(
+        fixture_dir,
+        addr = ('127.0.0.1', 0),
+        latency_sec = latency_sec,
+        jitter_sec = jitter_sec,
+        error_rate = error_rate,
+        reset_rate = reset_rate
+    ).start()
+    os.environ['http_proxy'] = server.get_proxy_url()
+
+    metrics.enable()
+
+    try:
+
+        try:
+            op.drop_tables()
+        except Exception as e:
+            debug('{}: {}'.format(e.__class__.__name__, e))
+        op.create_tables()
+
+        phase_ds = []
+
+        phase_ds.append(_run_phase(
+            'sync_routes',
+            lambda: model.sync_routes_on_all_route_indexes(pool=pool),
+            server
+        ))
+
+        phase_ds.append(_run_phase(
+            'sync_stops_n_phis',
+            lambda: model.sync_stops_n_phis_of_all_routes(
+                pool = pool,
+                chunk_size = chunk_size
+            ),
+            server
+        ))
+
+        phase_ds.append(_run_phase(
+            'sync_etas',
+            lambda: model.sync_etas_of_all_routes(
+                pool = pool,
+                chunk_size = chunk_size
+            ),
+            server
+        ))
+
+        _print_report(_count_routes(), phase_ds, server)
+
+    finally:
+        del os.environ['http_proxy']
+        server.stop()
+
+def _measure_peak_rss_mb(func):
+
+    # -> the peak rss above the baseline while func's return is alive
+
+    _reset_peak_rss()
+    base_mb = _get_peak_rss_mb()
+
+    val = func()
+    mb = _get_peak_rss_mb()-base_mb
+
+    del val
+    return mb
+
+def records(route_n=1000, stop_n=50):
+
+    # the peak rss of the phi and eta rows of a sweep, as the records and as
+    # the dicts they replaced
+
+    from datetime import datetime
+    from mrbus.record import Phi, Eta
+
+    now_dt = datetime.now()
+    keys = [
+        ('tp_{}'.format(i), sno)
+        for i in xrange(route_n)
+        for sno in xrange(stop_n*2)
+    ]
+
+    def make_phis():
+        return [
+            Phi(rid, sno, sno >= stop_n, sno, sno, 0, 3, 1.5, now_dt, now_dt)
+            for rid, sno in keys
+        ]
+
+    def make_phi_dicts():
+        return [
+            dict(zip(Phi.__slots__, (
+                rid, sno, sno >= stop_n, sno, sno, 0, 3, 1.5, now_dt, now_dt
+            )))
+            for rid, sno in keys
+        ]
+
+    def make_etas():
+        return [Eta(rid, sno, 0, 3, 1.5, now_dt) for rid, sno in keys]
+
+    def make_eta_dicts():
+        return [
+            dict(zip(Eta.__slots__, (rid, sno, 0, 3, 1.5, now_dt)))
+            for rid, sno in keys
+        ]
+
+    print 'rows        : {}'.format(len(keys))
+    print '{:<12} {:>10} {:>10}'.format('', 'record MB', 'dict MB')
+    for name, make_records, make_dicts in (
+        ('phi', make_phis, make_phi_dicts),
+        ('eta', make_etas, make_eta_dicts)
+    ):
+        print '{:<12} {:>10.1f} {:>10.1f}'.format(
+            name,
+            _measure_peak_rss_mb(make_records),
+            _measure_peak_rss_mb(make_dicts)
+        )
+
+# the heavy ones, which the entry points shall import only if they use
+_HEAVY_MODULE_NAMES = (
+    'psycopg2',
+    'requests',
+    'lxml',
+    'numpy',
+    'multiprocessing'
+)
+
+_IMPORT_SCRIPT = '''
+import sys, json, threading
+from time import time
+start_ts = time()
+import {module_name}
+sec = time()-start_ts
+print json.dumps({{
+    'sec'     : sec,
+    'heavy'   : [n for n in {heavy_module_names!r} if n in sys.modules],
+    'thread_n': threading.active_count()
+}})
+'''
+
+def _measure_import(module_name):
+
+    # in a new process, so it's cold
+
+    env = dict(os.environ, MRBUS_DEBUG='0')
+    out = subprocess.check_output([
+        sys.executable,
+        '-c',
+        _IMPORT_SCRIPT.format(
+            module_name = module_name,
+            heavy_module_names = _HEAVY_MODULE_NAMES
+        )
+    ], env=env)
+
+    return json.loads(out.splitlines()[-1])
+
+def imports(repeat_n=5):
+
+    # the import time of the entry points, and what they pull in
+
+    print '{:<16} {:>8} {:>8}  {}'.format('module', 'ms', 'threads', 'heavy')
+    for module_name in (
+        'mrbus.gov',
+        'mrbus.model',
+        'mrbus.op',
+        'mrbus.sched',
+        'mrbus.bench'
+    ):
+        ds = [_measure_import(module_name) for _ in xrange(repeat_n)]
+        print '{:<16} {:>8.1f} {:>8}  {}'.format(
+            module_name,
+            min(d['sec'] for d in ds)*1000,
+            ds[0]['thread_n'],
+            ', '.join(ds[0]['heavy']) or '-'
+        )
+
+if __name__ == '__main__':
+
+    import clime
+    clime.start(debug=True)
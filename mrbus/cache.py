@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from time import time
+from threading import Lock
+from collections import OrderedDict
+
+class LRUCache(object):
+
+    # a thread-safe, bounded LRU cache; entries also expire after ttl seconds
+    # if ttl is given
+    #
+    # an entry can be put with tags, then invalidate(tags) drops the entries
+    # which have any of them
+
+    def __init__(self, maxsize, ttl=None):
+
+        self._maxsize = maxsize
+        self._ttl = ttl
+
+        # key -> (expire_ts, val)
+        self._od = OrderedDict()
+        self._key_tags_map = {}
+        self._tag_keys_map = {}
+        self._lock = Lock()
+
+        self.hit_n = 0
+        self.miss_n = 0
+        self.eviction_n = 0
+        self.invalidation_n = 0
+
+    def __len__(self):
+        return len(self._od)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def get(self, key, default=None):
+
+        with self._lock:
+
+            try:
+                expire_ts, val = self._od.pop(key)
+            except KeyError:
+                self.miss_n += 1
+                return default
+
+            if expire_ts is not None and expire_ts < time():
+                self._untag(key)
+                self.miss_n += 1
+                return default
+
+            # move it to the most recent end
+            self._od[key] = (expire_ts, val)
+            self.hit_n += 1
+
+            return val
+
+    def _untag(self, key):
+        for tag in self._key_tags_map.pop(key, ()):
+            keys = self._tag_keys_map.get(tag)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if not keys:
+                del self._tag_keys_map[tag]
+
+    def put(self, key, val, tags=()):
+
+        expire_ts = None
+        if self._ttl is not None:
+            expire_ts = time()+self._ttl
+
+        with self._lock:
+
+            self._od.pop(key, None)
+            self._untag(key)
+            self._od[key] = (expire_ts, val)
+
+            if tags:
+                tags = self._key_tags_map[key] = frozenset(tags)
+                for tag in tags:
+                    self._tag_keys_map.setdefault(tag, set()).add(key)
+
+            while len(self._od) > self._maxsize:
+                evicted_key, _ = self._od.popitem(last=False)
+                self._untag(evicted_key)
+                self.eviction_n += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            self._untag(key)
+            expire_ts, val = self._od.pop(key, (None, default))
+            return val
+
+    def invalidate(self, tags):
+
+        # returns the number of the dropped entries
+
+        n = 0
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tag_keys_map.get(tag, ())):
+                    self._untag(key)
+                    if self._od.pop(key, None) is not None:
+                        n += 1
+            self.invalidation_n += n
+
+        return n
+
+    def clear(self):
+        with self._lock:
+            self._od.clear()
+            self._key_tags_map.clear()
+            self._tag_keys_map.clear()
+
+    def get_stats(self):
+        return {
+            'size'          : len(self._od),
+            'maxsize'       : self._maxsize,
+            'hit_n'         : self.hit_n,
+            'miss_n'        : self.miss_n,
+            'eviction_n'    : self.eviction_n,
+            'invalidation_n': self.invalidation_n
+        }
+
+if __name__ == '__main__':
+
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+
+    print 'b' in cache, cache.get('a'), cache.get('c')
+
+    cache.put('d', 4, tags=['x'])
+    print cache.invalidate(['x']), cache.get('d')
+    print cache.get_stats()
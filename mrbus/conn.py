@@ -1,13 +1,41 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import psycopg2
 from getpass import getuser
 from mosql.db import Database
 
-# let psycopg2 return unicode instead of 8-bit string
-psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
-psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
+def _import_psycopg2():
 
-db = Database(psycopg2, user=getuser())
+    # psycopg2 is imported on the first connection, not on import, so the
+    # entry points without db don't pay for it
 
+    import psycopg2
+
+    # let psycopg2 return unicode instead of 8-bit string
+    psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
+    psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
+
+    return psycopg2
+
+def _connect():
+    return _import_psycopg2().connect(user=getuser())
+
+db = Database()
+db.getconn = _connect
+
+def keep_conns(maxconn=16):
+
+    # keep the connections across the with blocks, for the long-running
+    # processes, e.g., mrbus.daemon; a closed one is discarded on putting
+    #
+    # maxconn: more than the threads using db at once
+
+    _import_psycopg2()
+    from psycopg2.pool import ThreadedConnectionPool
+
+    conn_pool = ThreadedConnectionPool(0, maxconn, user=getuser())
+
+    db.getconn = conn_pool.getconn
+    db.putconn = lambda conn: conn_pool.putconn(conn, close=bool(conn.closed))
+
+    return conn_pool
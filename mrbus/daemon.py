@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# the long-running sync, instead of the one-shot sweeps by cron
+#
+# it keeps the http sessions, the stop id cache, the indexes and the db
+# connections across the cycles. a cycle refreshes the due etas by
+# mrbus.sched until its budget, while the rare sweeps, the route indexes and
+# the topology, run overlapped on a background thread with their own pool, one
+# at a time. a cycle longer than its budget is reported as an overrun.
+#
+#     $ python -m mrbus.daemon run --cycle-sec=60 --metrics-port=9100
+#
+
+from time import time, sleep
+from mrbus.util import debug
+from mrbus.pool import Pool, spawn
+from mrbus.conn import keep_conns
+from mrbus.sched import Scheduler
+from mrbus.gov import set_sessions_per_host
+from mrbus import model, metrics
+
+_SWEEP_ROUTES = 'routes'
+_SWEEP_TOPOLOGY = 'topology'
+
+class Daemon(object):
+
+    # cycle_sec: the budget of a cycle
+    # routes_interval_sec: the interval of the route index sweep
+    # topology_interval_sec: the interval of the topology sweep
+    # sweep_budget_sec: the budget of a background sweep
+    # sweep_retry_sec: the delay to retry a failed sweep
+
+    def __init__(
+        self,
+        cycle_sec = 60,
+        routes_interval_sec = 86400,
+        topology_interval_sec = 21600,
+        sweep_budget_sec = 3600,
+        sweep_retry_sec = 300,
+        sweep_pool_size = 3,
+        chunk_size = 100,
+        scheduler = None
+    ):
+
+        self._cycle_sec = cycle_sec
+        self._sweep_budget_sec = sweep_budget_sec
+        self._sweep_retry_sec = sweep_retry_sec
+        self._chunk_size = chunk_size
+
+        self._sweep_name_interval_sec_map = {
+            _SWEEP_ROUTES  : routes_interval_sec,
+            _SWEEP_TOPOLOGY: topology_interval_sec
+        }
+        # when the sweeps are due next; 0 to run them soon
+        self._sweep_name_due_ts_map = dict.fromkeys(
+            self._sweep_name_interval_sec_map,
+            0
+        )
+
+        # so the etas don't queue behind the map pages of a sweep; the
+        # sessions are per host and shared, so they grow for its workers too
+        self._sweep_pool = Pool(sweep_pool_size)
+        set_sessions_per_host(model._POOL_SIZE+sweep_pool_size)
+        self._sweep_name = None
+        self._sweep_start_ts = None
+        self._sweep_future = None
+
+        if scheduler is None:
+            scheduler = Scheduler()
+        self._scheduler = scheduler
+
+        self.cycle_n = 0
+        self.overrun_n = 0
+
+    def _run_sweep(self, name):
+
+        if name == _SWEEP_ROUTES:
+            model.sync_routes_on_all_route_indexes(
+                pool = self._sweep_pool,
+                budget_sec = self._sweep_budget_sec
+            )
+        else:
+            model.sync_stops_n_phis_of_all_routes(
+                pool = self._sweep_pool,
+                chunk_size = self._chunk_size,
+                budget_sec = self._sweep_budget_sec
+            )
+
+    def _check_sweep(self):
+
+        # -> the name of the sweep just done, or None
+
+        future = self._sweep_future
+        if future is None or not future.done():
+            return None
+
+        name = self._sweep_name
+        self._sweep_name = None
+        self._sweep_future = None
+
+        exc = future.exception()
+        if exc is None:
+            self._sweep_name_due_ts_map[name] = (
+                self._sweep_start_ts+self._sweep_name_interval_sec_map[name]
+            )
+        else:
+            # retry soon, not after the full interval
+            self._sweep_name_due_ts_map[name] = time()+self._sweep_retry_sec
+            metrics.inc('mrbus_daemon_sweep_failures_total', sweep=name)
+            debug('the {} sweep failed: {}: {}'.format(
+                name,
+                exc.__class__.__name__,
+                exc
+            ))
+
+        return name
+
+    def _start_due_sweep(self, now_ts):
+
+        if self._sweep_future is not None:
+            return
+
+        # the route index first, as the topology sweeps its routes
+        for name in (_SWEEP_ROUTES, _SWEEP_TOPOLOGY):
+            if now_ts >= self._sweep_name_due_ts_map[name]:
+                break
+        else:
+            return
+
+        self._sweep_name = name
+        self._sweep_start_ts = now_ts
+        self._sweep_future = spawn(self._run_sweep, (name, ))
+        debug('started the {} sweep'.format(name))
+
+    def run_cycle(self):
+
+        # -> the seconds it took
+
+        start_ts = time()
+        end_ts = start_ts+self._cycle_sec
+
+        # the scheduler isn't thread-safe, so it's reloaded here
+        if self._check_sweep() == _SWEEP_ROUTES:
+            self._scheduler.reload_routes()
+        self._start_due_sweep(start_ts)
+
+        while True:
+            remaining_sec = end_ts-time()
+            if remaining_sec <= 0:
+                break
+            if not self._scheduler.run_once(budget_sec=remaining_sec):
+                break
+
+        sec = time()-start_ts
+        self.cycle_n += 1
+
+        metrics.observe('mrbus_daemon_cycle_seconds', sec)
+        if sec > self._cycle_sec:
+            self.overrun_n += 1
+            metrics.inc('mrbus_daemon_overruns_total')
+            debug('the cycle took {:.3f}s, over the budget {}s'.format(
+                sec,
+                self._cycle_sec
+            ))
+
+        return sec
+
+    def run(self, duration_sec=None):
+
+        start_ts = time()
+        self._scheduler.reload_routes()
+
+        while duration_sec is None or time()-start_ts < duration_sec:
+
+            self.run_cycle()
+
+            # nothing is due; the demands and the sweeps are checked every
+            # second
+            next_due_ts = self._scheduler.get_next_due_ts()
+            if next_due_ts is None:
+                sleep(1)
+            else:
+                sleep(min(max(next_due_ts-time(), 0), 1))
+
+    def get_stats(self):
+        return {
+            'cycle_n'  : self.cycle_n,
+            'overrun_n': self.overrun_n,
+            'sweep'    : self._sweep_name,
+            'scheduler': self._scheduler.get_stats()
+        }
+
+def run(
+    duration_sec=None, cycle_sec=60, routes_interval_sec=86400,
+    topology_interval_sec=21600, metrics_port=None
+):
+
+    keep_conns()
+
+    if metrics_port is not None:
+        metrics.enable()
+        metrics.serve(metrics_port)
+
+    daemon = Daemon(
+        cycle_sec = cycle_sec,
+        routes_interval_sec = routes_interval_sec,
+        topology_interval_sec = topology_interval_sec
+    )
+    metrics.register_gauge('mrbus_daemon_cycle_n', lambda: daemon.cycle_n)
+
+    try:
+        daemon.run(duration_sec)
+    finally:
+        debug(daemon.get_stats())
+
+if __name__ == '__main__':
+
+    import clime
+    clime.start(debug=True)
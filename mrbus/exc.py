@@ -6,3 +6,6 @@ class RouteIDError(ValueError):
 
 class RouteNameError(ValueError):
     pass
+
+class TimeoutError(RuntimeError):
+    pass
@@ -7,59 +7,722 @@ __all__ = [
 ]
 
 import re
+import sys
 import json
-import requests
+from hashlib import md5
 from time import time, sleep
+from random import uniform
+from threading import Condition, Lock
+from contextlib import contextmanager
 from urlparse import urlparse, parse_qs
-from lxml import html
 from mrbus.util import debug
+from mrbus import metrics
+from mrbus.exc import TimeoutError
+from mrbus.record import make_bus
+from mrbus.pool import Future, spawn, as_completed
 
 # basic concept here:
 #
 # 1. fetch something via network
 # 2. parse it
 # 3. transform if need
-# 4. then cache within instance
+# 4. then cache within instance, and share a short ttl across them, see _fly
 # 5. public get_* to get cahce or op the above procedures
 #
+# requests, lxml and multiprocessing are imported by the functions using
+# them, so importing it, e.g., by mrbus.model for the queries, is cheap.
+#
 
 _HEADERS = {
+    'Accept-Encoding': 'gzip, deflate',
     'Referer': 'https://www.google.com/',
     'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36'
 }
 
-def _fetch_text(url, referer=None, encoding=None, retry_n=3, default_val=''):
+def _create_session():
+
+    import requests
+
+    session = requests.Session()
+    session.headers.update(_HEADERS)
+
+    # a session is borrowed by one thread at a time, so one connection is enough
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+class _SessionPool(object):
+
+    # a thread-safe pool of keep-alive sessions to a single host
+
+    def __init__(self, size):
+        self._size = size
+        self._created_n = 0
+        self._idle_sessions = []
+        self._cond = Condition()
+
+    def resize(self, size):
+        with self._cond:
+            self._size = size
+            self._cond.notify_all()
+
+    def has_idle(self):
+        # a session can be borrowed without waiting
+        with self._cond:
+            return bool(self._idle_sessions) or self._created_n < self._size
+
+    def _acquire(self):
+        with self._cond:
+            while True:
+                # LIFO keeps the recently used connections warm
+                if self._idle_sessions:
+                    return self._idle_sessions.pop()
+                if self._created_n < self._size:
+                    self._created_n += 1
+                    return _create_session()
+                self._cond.wait()
+
+    def _release(self, session):
+        with self._cond:
+            if self._created_n > self._size:
+                # shrunk since borrowed
+                self._created_n -= 1
+                session.close()
+            else:
+                self._idle_sessions.append(session)
+            self._cond.notify()
+
+    @contextmanager
+    def borrow(self):
+        session = self._acquire()
+        try:
+            yield session
+        finally:
+            self._release(session)
+
+class _LatencyWindow(object):
+
+    # the latencies of the recent requests to a host
+
+    def __init__(self, size=200):
+        self._size = size
+        self._secs = []
+        self._next_i = 0
+        self._lock = Lock()
+
+    def add(self, sec):
+        with self._lock:
+            if len(self._secs) < self._size:
+                self._secs.append(sec)
+            else:
+                self._secs[self._next_i] = sec
+                self._next_i = (self._next_i+1) % self._size
+
+    def get_quantile(self, q, min_n=20):
+        # None if the samples are too few to tell
+        with self._lock:
+            if len(self._secs) < min_n:
+                return None
+            secs = sorted(self._secs)
+        return secs[min(int(len(secs)*q), len(secs)-1)]
+
+# the outcomes of a request, for _AdaptiveLimiter
+_OUTCOME_OK = 'ok'
+_OUTCOME_SLOW = 'slow'
+_OUTCOME_CONGESTED = 'congested'
+
+class _AdaptiveLimiter(object):
+
+    # a token bucket with a concurrency window, both adapted by AIMD:
+    #
+    # 1. an ok request grows them additively, about +1 per window
+    # 2. a slow one, which is much slower than usual, holds them
+    # 3. a 5xx, 429, timeout or connection reset halves them
+    #
+    # ref: https://en.wikipedia.org/wiki/Additive_increase/multiplicative_decrease
+
+    def __init__(
+        self,
+        concurrency=4, max_concurrency=64,
+        rate=20, min_rate=1, max_rate=500
+    ):
+
+        self._concurrency = float(concurrency)
+        self._max_concurrency = max_concurrency
+
+        # rate: tokens per second; the bucket holds 1s of tokens
+        self._rate = float(rate)
+        self._min_rate = min_rate
+        self._max_rate = max_rate
+        self._token_n = self._rate
+        self._refilled_ts = time()
+
+        self._inflight_n = 0
+        self._cond = Condition()
+
+    def _refill(self):
+        now_ts = time()
+        self._token_n = min(
+            self._rate,
+            self._token_n+(now_ts-self._refilled_ts)*self._rate
+        )
+        self._refilled_ts = now_ts
+
+    def acquire(self, end_ts=None):
+
+        # returns False if it can't acquire before end_ts
+
+        with self._cond:
+
+            while True:
+
+                self._refill()
+
+                if self._inflight_n < int(self._concurrency):
+                    if self._token_n >= 1:
+                        self._token_n -= 1
+                        self._inflight_n += 1
+                        return True
+                    wait_sec = (1-self._token_n)/self._rate
+                else:
+                    # until a release
+                    wait_sec = None
+
+                if end_ts is not None:
+                    remaining_sec = end_ts-time()
+                    if remaining_sec <= 0:
+                        return False
+                    wait_sec = min(wait_sec or remaining_sec, remaining_sec)
+
+                self._cond.wait(wait_sec)
+
+    def release(self, outcome=None):
+
+        # outcome: None means it tells nothing about the host, e.g., a 404
+
+        with self._cond:
+
+            self._inflight_n -= 1
+
+            if outcome == _OUTCOME_OK:
+                self._concurrency = min(
+                    self._max_concurrency,
+                    self._concurrency+1/self._concurrency
+                )
+                self._rate = min(
+                    self._max_rate,
+                    self._rate+5/self._concurrency
+                )
+            elif outcome == _OUTCOME_CONGESTED:
+                self._concurrency = max(1, self._concurrency/2)
+                self._rate = max(self._min_rate, self._rate/2)
+                self._token_n = min(self._token_n, 0)
+                debug('halved to concurrency {:.1f} and rate {:.1f}/s'.format(
+                    self._concurrency,
+                    self._rate
+                ))
+
+            self._cond.notify_all()
+
+    def get_stats(self):
+        return {
+            'concurrency': self._concurrency,
+            'rate'       : self._rate,
+            'inflight_n' : self._inflight_n
+        }
+
+class _Host(object):
+
+    # the states we keep for each host
+
+    def __init__(self, netloc, session_n):
+
+        self.netloc = netloc
+        self.session_pool = _SessionPool(session_n)
+        self.latency_window = _LatencyWindow()
+        self.limiter = _AdaptiveLimiter()
+
+        for stat_name in ('concurrency', 'rate', 'inflight_n'):
+            metrics.register_gauge(
+                'mrbus_limiter_'+stat_name,
+                lambda k=stat_name: self.limiter.get_stats()[k],
+                host = netloc
+            )
+
+    def judge_latency(self, sec):
+        # it is flat unless it is much slower than the median
+        median_sec = self.latency_window.get_quantile(0.5)
+        if median_sec is not None and sec > median_sec*2:
+            return _OUTCOME_SLOW
+        return _OUTCOME_OK
+
+_sessions_per_host = 3
+_netloc_host_map = {}
+_netloc_host_map_lock = Lock()
+
+def set_sessions_per_host(n):
+
+    global _sessions_per_host
+
+    with _netloc_host_map_lock:
+        _sessions_per_host = n
+        for host in _netloc_host_map.itervalues():
+            host.session_pool.resize(n)
+
+def _get_host(url):
+
+    netloc = urlparse(url).netloc
+
+    with _netloc_host_map_lock:
+        host = _netloc_host_map.get(netloc)
+        if host is None:
+            host = _netloc_host_map[netloc] = _Host(
+                netloc,
+                _sessions_per_host
+            )
+
+    return host
+
+# (connect, read) in seconds
+# ref: http://docs.python-requests.org/en/latest/user/advanced/#timeouts
+_TIMEOUT = (3.05, 10)
+
+def _get_timeout(end_ts):
+
+    # None if the deadline is passed
+
+    if end_ts is None:
+        return _TIMEOUT
+
+    remaining_sec = end_ts-time()
+    if remaining_sec <= 0:
+        return None
+
+    return tuple(min(sec, remaining_sec) for sec in _TIMEOUT)
+
+_BACKOFF_BASE_SEC = 0.5
+_BACKOFF_CAP_SEC = 8
+
+def _sleep_backoff(attempt_n, end_ts):
+
+    # exponential backoff with full jitter
+    # ref: https://www.awsarchitectureblog.com/2015/03/backoff.html
+
+    sec = uniform(0, min(_BACKOFF_CAP_SEC, _BACKOFF_BASE_SEC*2**attempt_n))
+    if end_ts is not None:
+        sec = min(sec, end_ts-time())
+
+    if sec > 0:
+        sleep(sec)
 
-    headers = _HEADERS
+# hedge a request if it takes longer than this quantile of the host's
+# recent latencies; None to disable
+_hedge_quantile = None
+
+def set_hedge_quantile(q):
+    global _hedge_quantile
+    _hedge_quantile = q
+
+def _observe_request(host, url, status, sec):
+
+    if not metrics.is_enabled:
+        return
+
+    endpoint = urlparse(url).path
+
+    metrics.inc(
+        'mrbus_http_requests_total',
+        host = host.netloc,
+        endpoint = endpoint,
+        status = status
+    )
+    metrics.observe(
+        'mrbus_http_request_seconds', sec,
+        host = host.netloc,
+        endpoint = endpoint
+    )
+
+def _get(host, url, headers, timeout, end_ts):
+
+    import requests
+
+    if not host.limiter.acquire(end_ts):
+        raise requests.Timeout('limited until the deadline')
+
+    outcome = None
+
+    try:
+
+        with host.session_pool.borrow() as session:
+
+            # after borrowing, or the wait for a session, which is ours, is
+            # taken as the host's latency
+            start_ts = time()
+
+            try:
+                resp = session.get(url, headers=headers, timeout=timeout)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                outcome = _OUTCOME_CONGESTED
+                _observe_request(
+                    host, url, e.__class__.__name__, time()-start_ts
+                )
+                raise
+
+            latency_sec = time()-start_ts
+
+        _observe_request(host, url, resp.status_code, latency_sec)
+
+        if resp.status_code >= 500 or resp.status_code == 429:
+            outcome = _OUTCOME_CONGESTED
+        elif resp.ok:
+            outcome = host.judge_latency(latency_sec)
+            host.latency_window.add(latency_sec)
+
+        resp.raise_for_status()
+
+    finally:
+        host.limiter.release(outcome)
+
+    return resp
+
+def _get_hedged(host, url, headers, timeout, end_ts):
+
+    hedge_sec = None
+    if _hedge_quantile is not None:
+        hedge_sec = host.latency_window.get_quantile(_hedge_quantile)
+
+    if hedge_sec is None:
+        return _get(host, url, headers, timeout, end_ts)
+
+    futures = [spawn(_get, (host, url, headers, timeout, end_ts))]
+
+    try:
+        return futures[0].result(hedge_sec)
+    except TimeoutError:
+        # only on a spare session; or the hedge just waits for one, and the
+        # loser holds it from the others
+        if host.session_pool.has_idle():
+            metrics.inc('mrbus_http_hedges_total', host=host.netloc)
+            futures.append(spawn(_get, (host, url, headers, timeout, end_ts)))
+        else:
+            metrics.inc('mrbus_http_hedges_skipped_total', host=host.netloc)
+
+    # the first succeeded one wins
+    exc = None
+    for future in as_completed(futures):
+        exc = future.exception()
+        if exc is None:
+            return future.result()
+
+    raise exc
+
+def _fetch_text(
+    url, referer=None, encoding=None, retry_n=3, default_val='', end_ts=None
+):
+
+    # end_ts: the deadline; no request is sent after it
+
+    headers = None
     if referer is not None:
-        headers = _HEADERS.copy()
-        headers['Referer'] = referer
+        headers = {'Referer': referer}
+
+    host = _get_host(url)
+
+    with metrics.timed('mrbus_phase_seconds', phase='fetch'):
+
+        attempt_n = 0
+        while attempt_n < retry_n:
+
+            if attempt_n:
+                _sleep_backoff(attempt_n, end_ts)
+
+            timeout = _get_timeout(end_ts)
+            if timeout is None:
+                debug('deadline passed before GET {}'.format(url))
+                return default_val
+
+            attempt_n += 1
+
+            try:
+                resp = _get_hedged(host, url, headers, timeout, end_ts)
+            except IOError:
+                metrics.inc('mrbus_http_retries_total', host=host.netloc)
+                continue
+
+            break
+
+        else:
+            return default_val
+
+        if encoding is not None:
+            resp.encoding = encoding
+
+        return resp.text
+
+# the single flight
+#
+# the concurrent calls of the same key wait on the future of the one in
+# flight, and the done one is shared for _flight_ttl_sec, which is shorter
+# than a sync cycle, so the page objects of the same url in a cycle fetch and
+# parse it only once. a falsy result, i.e., failed, isn't shared once done.
+
+_flight_ttl_sec = 10
+
+# key -> [future, done_ts]
+_key_flight_map = {}
+_key_flight_map_lock = Lock()
+_flight_pruned_ts = 0.
+
+def set_flight_ttl_sec(sec):
+    # 0 to share the in-flight only
+    global _flight_ttl_sec
+    _flight_ttl_sec = sec
+
+def _prune_flights(now_ts):
+
+    global _flight_pruned_ts
+
+    if now_ts-_flight_pruned_ts < _flight_ttl_sec:
+        return
+    _flight_pruned_ts = now_ts
 
-    while retry_n:
+    for key, (_, done_ts) in _key_flight_map.items():
+        if done_ts is not None and now_ts-done_ts >= _flight_ttl_sec:
+            del _key_flight_map[key]
 
-        debug('GET {}'.format(url))
+def _fly(key, func, end_ts=None, default_val=None):
+
+    # end_ts: the deadline of waiting; default_val is returned after it
+
+    now_ts = time()
+
+    with _key_flight_map_lock:
+
+        _prune_flights(now_ts)
+
+        flight = _key_flight_map.get(key)
+        if flight is not None:
+            future, done_ts = flight
+            if done_ts is not None and now_ts-done_ts >= _flight_ttl_sec:
+                flight = None
+
+        it_is_leader = flight is None
+        if it_is_leader:
+            future = Future()
+            flight = _key_flight_map[key] = [future, None]
+
+    if not it_is_leader:
+
+        metrics.inc(
+            'mrbus_flights_total',
+            role = 'waiter' if done_ts is None else 'cached'
+        )
+
+        timeout = None
+        if end_ts is not None:
+            timeout = max(end_ts-time(), 0)
 
         try:
-            resp = requests.get(url, headers=headers)
-            resp.raise_for_status()
-        except IOError:
-            retry_n -= 1
-            sleep(1)
-            continue
+            val = future.result(timeout)
+        except TimeoutError:
+            debug('deadline passed before {} landed'.format(key))
+            return default_val
+
+        # the leader's miss, e.g., of its own earlier deadline, is not shared
+        # with a waiter which still has time
+        if not val and (end_ts is None or time() < end_ts):
+            metrics.inc('mrbus_flights_total', role='refetcher')
+            return func()
+
+        return val
+
+    metrics.inc('mrbus_flights_total', role='leader')
+
+    try:
+        val = func()
+    except BaseException as e:
+        with _key_flight_map_lock:
+            _key_flight_map.pop(key, None)
+        future.set_exception(e, sys.exc_info())
+        raise
+
+    with _key_flight_map_lock:
+        if val:
+            flight[1] = time()
+        elif _key_flight_map.get(key) is flight:
+            del _key_flight_map[key]
+    future.set_result(val)
+
+    return val
+
+def _fetch_text_once(url, key=None, end_ts=None, **kargs):
+    # key: the url by default
+    return _fly(
+        ('fetch', key or url),
+        lambda: _fetch_text(url, end_ts=end_ts, **kargs),
+        end_ts = end_ts,
+        default_val = kargs.get('default_val', '')
+    )
+
+# the parse stage
+#
+# the parsers are module-level functions from the text to tuples, so they
+# can run in a process pool, out of the GIL of the fetching threads; the
+# results are turned into dicts by the callers. it's in-thread by default,
+# call set_parse_processes(n) early, before the sync starts, to enable it.
+#
+# it doesn't work with mrbus.green, as the monkey-patched threads of
+# multiprocessing.Pool never switch.
+
+_PARSE_TIMEOUT_SEC = 60
+
+_parse_pool = None
+
+def set_parse_processes(n):
+
+    # n: the number of the processes, or 0 to parse in-thread
+
+    import multiprocessing
+
+    global _parse_pool
+
+    if _parse_pool is not None:
+        _parse_pool.close()
+        _parse_pool.join()
+        _parse_pool = None
+
+    if n:
+        _parse_pool = multiprocessing.Pool(n)
+
+def _parse(func, text):
+
+    if not text:
+        return func(text)
+
+    with metrics.timed('mrbus_phase_seconds', phase='parse'):
+        if _parse_pool is None:
+            return func(text)
+        # get with a timeout, or it can't be interrupted on Python 2
+        return _parse_pool.apply_async(func, (text, )).get(_PARSE_TIMEOUT_SEC)
+
+def _parse_once(func, text):
+    # the parsed tuples are shared by the callers as is, so they must not
+    # mutate them, nor the values in them, e.g., the etas from json
+    if not text:
+        return func(text)
+    return _fly(
+        ('parse', func.__name__, _hash_text(text)),
+        lambda: _parse(func, text)
+    )
+
+def _parse_taipei_index(text):
+
+    # -> ((name, rid), ...)
+
+    if not text:
+        return ()
+
+    nocomment_text = TaipeiRouteIndex.JS_BLOCK_COMMENT_RE.sub('', text)
+
+    pairs = []
+    for m in TaipeiRouteIndex.EBUS_CALL_RE.finditer(nocomment_text):
+        pairs.append((m.group('name'), m.group('rid')))
+    for m in TaipeiRouteIndex.EBUS_A_RE.finditer(nocomment_text):
+        pairs.append((m.group('name'), m.group('rid')))
+
+    return tuple(pairs)
+
+def _parse_new_taipei_index(text):
+
+    # -> ((name, rid), ...)
+
+    if not text:
+        return ()
+
+    from lxml import html
+
+    pairs = []
+
+    root = html.fromstring(text)
+    for a in root.xpath('//a'):
+
+        r = urlparse(a.get('href'))
+        if r.path == '../NTPCRoute/Tw/Map':
+
+            d = parse_qs(r.query)
+            if 'rid' in d:
+                pairs.append((a.text, d['rid'][0]))
+
+    return tuple(pairs)
+
+def _parse_route_page(page_text):
+
+    # -> ((idx, name), ...)
+
+    if not page_text:
+        return ()
+
+    from lxml import html
+
+    pairs = []
+
+    root = html.fromstring(page_text)
+    for stop_div in root.xpath("//*[contains(@class, 'stop ')]"):
+        stop_idx = int(
+            stop_div
+            .xpath(".//*[@class='eta']")[0]
+            .get('id')
+            .partition('_')[2]
+        )
+        stop_name = stop_div.xpath(".//*[@class='stopName']")[0][0].text
+        pairs.append((stop_idx, stop_name))
+
+    return tuple(pairs)
+
+def _parse_route_api(api_text):
+
+    # -> (((idx, eta), ...), ((idx, Bus), ...))
 
-        break
+    if not api_text:
+        return ((), ())
 
-    else:
-        return default_val
+    try:
+        api_d = json.loads(api_text)
+    except ValueError:
+        # ValueError: No JSON object could be decoded
+        # some of routes only has departure part (sec=0).
+        # if you ask the return part (sec=1),
+        # the page and api will return 'Not found' literally;
+        # we translate it into empty dict.
+        return ((), ())
 
-    if encoding is not None:
-        resp.encoding = encoding
+    # eta -> 255 means 未發車
+    # eta -> 254 means 末班車已過
 
-    return resp.text
+    # the buses, see mrbus.record.Bus
+
+    return (
+        tuple((d['idx'], d['eta']) for d in api_d['Etas']),
+        tuple((d['idx'], make_bus(d)) for d in api_d['Buses'])
+    )
+
+def _hash_text(text):
+    # None if it's failed to fetch
+    if not text:
+        return None
+    return md5(text.encode('utf-8')).hexdigest()
+
+def _is_changed(hash_, last_hash):
+    return hash_ is None or hash_ != last_hash
 
 class _RouteIndex(object):
 
-    def __init__(self):
+    # end_ts: the deadline of the fetching, see _fetch_text
+
+    def __init__(self, end_ts=None):
+        self._end_ts = end_ts
         self._name_rid_map = None
 
     def _fetch_index_text(self):
@@ -70,9 +733,8 @@ class _RouteIndex(object):
 
     def get_name_rid_map(self):
         if self._name_rid_map is None:
-            self._name_rid_map = self._parse_to_name_rid_map(
-                self._fetch_index_text()
-            )
+            text = self._fetch_index_text()
+            self._name_rid_map = self._parse_to_name_rid_map(text)
         return self._name_rid_map
 
 class TaipeiRouteIndex(_RouteIndex):
@@ -80,9 +742,10 @@ class TaipeiRouteIndex(_RouteIndex):
     URL = 'http://e-bus.taipei.gov.tw/'
 
     def _fetch_index_text(self):
-        return _fetch_text(
+        return _fetch_text_once(
             self.URL,
-            encoding = 'utf-8'
+            encoding = 'utf-8',
+            end_ts = self._end_ts
         )
 
     JS_BLOCK_COMMENT_RE = re.compile(ur'/\*.*?\*/', re.S)
@@ -90,45 +753,21 @@ class TaipeiRouteIndex(_RouteIndex):
     EBUS_A_RE = re.compile(ur'''<a href='javascript:openEbus1?\("(?P<rid>.+?)"\)'>(?P<name>.+?)</a>''')
 
     def _parse_to_name_rid_map(self, text):
-
-        if not text:
-            return {}
-
-        name_rid_map = {}
-
-        nocomment_text = self.JS_BLOCK_COMMENT_RE.sub('', text)
-        for m in self.EBUS_CALL_RE.finditer(nocomment_text):
-            name_rid_map[m.group('name')] = m.group('rid')
-        for m in self.EBUS_A_RE.finditer(nocomment_text):
-            name_rid_map[m.group('name')] = m.group('rid')
-
-        return name_rid_map
+        return dict(_parse_once(_parse_taipei_index, text))
 
 class NewTaipeiRouteIndex(_RouteIndex):
 
     URL = 'http://e-bus.ntpc.gov.tw/'
 
     def _fetch_index_text(self):
-        return _fetch_text(self.URL, encoding='utf-8')
+        return _fetch_text_once(
+            self.URL,
+            encoding = 'utf-8',
+            end_ts = self._end_ts
+        )
 
     def _parse_to_name_rid_map(self, text):
-
-        if not text:
-            return {}
-
-        name_rid_map = {}
-
-        root = html.fromstring(text)
-        for a in root.xpath('//a'):
-
-            r = urlparse(a.get('href'))
-            if r.path == '../NTPCRoute/Tw/Map':
-
-                d = parse_qs(r.query)
-                if 'rid' in d:
-                    name_rid_map[a.text] = d['rid'][0]
-
-        return name_rid_map
+        return dict(_parse_once(_parse_new_taipei_index, text))
 
 class _RoutePage(object):
 
@@ -152,109 +791,124 @@ class _RoutePage(object):
     def _format_api_url(cls, rid, sec):
         return cls._API_URL_TPL.format(rid=rid, sec=sec, _=int(time()*1000))
 
-    def __init__(self, rid, sec):
+    @classmethod
+    def _format_api_key(cls, rid, sec):
+        # without the cache buster
+        return cls._API_URL_TPL.format(rid=rid, sec=sec, _='')
+
+    def __init__(self, rid, sec, end_ts=None, last_hashes=(None, None)):
 
         self._rid = rid
         self._sec = sec
+        # the deadline of the fetching, see _fetch_text
+        self._end_ts = end_ts
+
+        # the hashes of the page and the api text of the last sync; a text
+        # with the same hash is kept unparsed until someone asks
+        self._last_page_hash, self._last_api_hash = last_hashes
+
+        self.page_hash = None
+        self.api_hash = None
+
+        self._is_page_loaded = False
+        self._page_text = None
+        self._is_api_loaded = False
+        self._api_text = None
 
         self._idx_name_map = None
         self._idx_eta_map = None
         self._idx_bus_map = None
 
     def _fetch_page_text(self):
-        return _fetch_text(
+        return _fetch_text_once(
             self._format_page_url(self._rid, self._sec),
-            referer = TaipeiRouteIndex.URL
+            referer = TaipeiRouteIndex.URL,
+            end_ts = self._end_ts
         )
 
     def _fetch_api_text(self):
-        return _fetch_text(
+        return _fetch_text_once(
             self._format_api_url(self._rid, self._sec),
+            key = self._format_api_key(self._rid, self._sec),
             referer = self._format_page_url(self._rid, self._sec),
+            end_ts = self._end_ts
         )
 
     def _parse_to_idx_name_map(self, page_text):
+        return dict(_parse_once(_parse_route_page, page_text))
 
-        if not page_text:
-            return {}
-
-        idx_name_map = {}
+    def _parse_to_map_pair(self, api_text):
+        idx_eta_pairs, idx_bus_pairs = _parse_once(_parse_route_api, api_text)
+        return (dict(idx_eta_pairs), dict(idx_bus_pairs))
 
-        root = html.fromstring(page_text)
-        for stop_div in root.xpath("//*[contains(@class, 'stop ')]"):
-            stop_idx = int(
-                stop_div
-                .xpath(".//*[@class='eta']")[0]
-                .get('id')
-                .partition('_')[2]
-            )
-            stop_name = stop_div.xpath(".//*[@class='stopName']")[0][0].text
-            idx_name_map[stop_idx] = stop_name
+    def load_page(self):
 
-        return idx_name_map
+        # fetch the page, and parse it if it changed
 
-    def _transform_to_idx_eta_map(self, api_d):
+        if self._is_page_loaded:
+            return
 
-        # eta -> 255 means 未發車
-        # eta -> 254 means 末班車已過
+        page_text = self._fetch_page_text()
+        self.page_hash = _hash_text(page_text)
 
-        return {
-            d['idx']: d['eta']
-            for d in api_d['Etas']
-        }
+        if _is_changed(self.page_hash, self._last_page_hash):
+            self._idx_name_map = self._parse_to_idx_name_map(page_text)
+        else:
+            self._page_text = page_text
 
-    def _transform_to_idx_bus_map(self, api_d):
+        self._is_page_loaded = True
 
-        # fl -> "h" means 一般公車
-        # fl -> "l" means 低地板公車
+    def is_page_changed(self):
+        self.load_page()
+        return _is_changed(self.page_hash, self._last_page_hash)
 
-        # io -> "i" means 進站中
-        # io -> "o" means 離站中
+    def get_idx_name_map(self):
+        if self._idx_name_map is None:
+            self.load_page()
+        if self._idx_name_map is None:
+            self._idx_name_map = self._parse_to_idx_name_map(self._page_text)
+            self._page_text = None
+        return self._idx_name_map
 
-        return {
-            d['idx']: d
-            for d in api_d['Buses']
-        }
+    def load_api(self):
 
-    def _parse_to_map_pair(self, api_text):
+        # fetch the api, and parse it if it changed
 
-        if not api_text:
-            return ({}, {})
+        if self._is_api_loaded:
+            return
 
-        try:
-            api_d = json.loads(api_text)
-        except ValueError:
-            # ValueError: No JSON object could be decoded
-            # some of routes only has departure part (sec=0).
-            # if you ask the return part (sec=1),
-            # the page and api will return 'Not found' literally;
-            # we translate it into empty dict.
-            return ({}, {})
-
-        return (
-            self._transform_to_idx_eta_map(api_d),
-            self._transform_to_idx_bus_map(api_d)
-        )
+        api_text = self._fetch_api_text()
+        self.api_hash = _hash_text(api_text)
 
-    def get_idx_name_map(self):
-        if self._idx_name_map is None:
-            self._idx_name_map = self._parse_to_idx_name_map(
-                self._fetch_page_text()
+        if _is_changed(self.api_hash, self._last_api_hash):
+            self._idx_eta_map, self._idx_bus_map = self._parse_to_map_pair(
+                api_text
             )
-        return self._idx_name_map
+        else:
+            self._api_text = api_text
 
-    def get_idx_eta_map(self):
+        self._is_api_loaded = True
+
+    def is_api_changed(self):
+        self.load_api()
+        return _is_changed(self.api_hash, self._last_api_hash)
+
+    def _load_map_pair(self):
+        self.load_api()
         if self._idx_eta_map is None:
             self._idx_eta_map, self._idx_bus_map = self._parse_to_map_pair(
-                self._fetch_api_text()
+                self._api_text
             )
+            self._api_text = None
+
+    def get_idx_eta_map(self):
+        if self._idx_eta_map is None:
+            self._load_map_pair()
         return self._idx_eta_map
 
     def get_idx_bus_map(self):
         if self._idx_bus_map is None:
-            self._idx_eta_map, self._idx_bus_map = self._parse_to_map_pair(
-                self._fetch_api_text()
-            )
+            self._load_map_pair()
         return self._idx_bus_map
 
 class TaipeiRoutePage(_RoutePage):
@@ -0,0 +1,546 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# an in-process index of the phis, for answering the plans without db
+#
+# it is array-backed: each route keeps its phis as parallel arrays ordered by
+# serial_no, and each stop keeps its postings, the (route, position) entries
+# packed into an array of ints. see mrbus.model for loading and patching it.
+
+from time import time
+from array import array
+from threading import Lock
+
+_NAN = float('nan')
+
+# a posting: route_no << _POS_BITS | position on the route
+_POS_BITS = 16
+_POS_MASK = (1 << _POS_BITS)-1
+
+# for the routes which have no interval_min at all
+_DEFAULT_INTERVAL_MIN = 2.
+
+def _to_float(x):
+    if x is None:
+        return _NAN
+    return float(x)
+
+class _Route(object):
+
+    def __init__(self, route_id, name):
+
+        self.id = route_id
+        self.name = name
+
+        # ordered by serial_no
+        self.serial_nos = array('h')
+        self.it_is_returns = array('b')
+        self.stop_ids = array('i')
+        # nan for unknown
+        self.interval_mins = array('d')
+        self._cum_mins = None
+
+    def __len__(self):
+        return len(self.serial_nos)
+
+    def set_phis(self, phi_rows):
+
+        # phi_rows: [(serial_no, it_is_return, stop_id, interval_min), ...]
+
+        serial_nos = array('h')
+        it_is_returns = array('b')
+        stop_ids = array('i')
+        interval_mins = array('d')
+
+        for serial_no, it_is_return, stop_id, interval_min in sorted(phi_rows):
+            serial_nos.append(serial_no)
+            it_is_returns.append(it_is_return)
+            stop_ids.append(stop_id)
+            interval_mins.append(_to_float(interval_min))
+
+        self.serial_nos = serial_nos
+        self.it_is_returns = it_is_returns
+        self.stop_ids = stop_ids
+        self.interval_mins = interval_mins
+        self._cum_mins = None
+
+    def invalidate_cum_mins(self):
+        self._cum_mins = None
+
+    def get_cum_mins(self):
+
+        # the driving_min from position i to j is cum_mins[j]-cum_mins[i], as
+        # interval_min is the time from last stop to this stop; the unknown
+        # ones are filled by the mean of this route
+
+        if self._cum_mins is not None:
+            return self._cum_mins
+
+        known_mins = [x for x in self.interval_mins if x == x]
+        if known_mins:
+            default_min = sum(known_mins)/len(known_mins)
+        else:
+            default_min = _DEFAULT_INTERVAL_MIN
+
+        cum_mins = array('d')
+        total_min = 0.
+        for i, interval_min in enumerate(self.interval_mins):
+            if i:
+                if interval_min == interval_min:
+                    total_min += interval_min
+                else:
+                    total_min += default_min
+            cum_mins.append(total_min)
+
+        self._cum_mins = cum_mins
+        return cum_mins
+
+    def get_driving_min(self, from_pos, to_pos):
+        cum_mins = self.get_cum_mins()
+        return cum_mins[to_pos]-cum_mins[from_pos]
+
+    def get_phis(self):
+        return zip(
+            self.serial_nos,
+            self.it_is_returns,
+            self.stop_ids,
+            self.interval_mins
+        )
+
+    def find_pos(self, serial_no):
+        # the serial_nos are sorted and nearly dense
+        serial_nos = self.serial_nos
+        lo, hi = 0, len(serial_nos)
+        while lo < hi:
+            mid = (lo+hi)//2
+            if serial_nos[mid] < serial_no:
+                lo = mid+1
+            else:
+                hi = mid
+        if lo < len(serial_nos) and serial_nos[lo] == serial_no:
+            return lo
+        return -1
+
+class PhiIndex(object):
+
+    # it is thread-safe; the queries and the patches are serialized by a
+    # lock, but both are short, and a full load is built aside then swapped.
+
+    def __init__(self):
+        self._lock = Lock()
+        self._clear()
+        self.loaded_ts = None
+
+    def _clear(self):
+        self._routes = []
+        self._rid_rno_map = {}
+        self._sid_sname_map = {}
+        # stop_id -> array of postings
+        self._sid_postings_map = {}
+
+    def is_loaded(self):
+        return self.loaded_ts is not None
+
+    def load(self, route_rows, stop_rows, phi_rows):
+
+        # route_rows: [(id, name), ...]
+        # stop_rows: [(id, name), ...]
+        # phi_rows: [(route_id, serial_no, it_is_return, stop_id,
+        #             interval_min), ...]
+
+        index = PhiIndex()
+        index._patch(route_rows, phi_rows, stop_rows)
+
+        with self._lock:
+            self._routes = index._routes
+            self._rid_rno_map = index._rid_rno_map
+            self._sid_sname_map = index._sid_sname_map
+            self._sid_postings_map = index._sid_postings_map
+            self.loaded_ts = time()
+
+    def patch(self, route_rows, phi_rows, stop_rows=(), removed_phi_rows=()):
+
+        # merge the rows written by a sync; the phis not in phi_rows are kept,
+        # as the upsert keeps them in db, unless they are in removed_phi_rows,
+        # the (route_id, serial_no, ...) deleted from a shortened route
+
+        with self._lock:
+            self._patch(route_rows, phi_rows, stop_rows, removed_phi_rows)
+
+    def _patch(self, route_rows, phi_rows, stop_rows, removed_phi_rows=()):
+
+        self._sid_sname_map.update(stop_rows)
+
+        for route_id, name in route_rows:
+            rno = self._rid_rno_map.get(route_id)
+            if rno is None:
+                self._rid_rno_map[route_id] = len(self._routes)
+                self._routes.append(_Route(route_id, name))
+            else:
+                self._routes[rno].name = name
+
+        rid_phi_rows_map = {}
+        for route_id, serial_no, it_is_return, stop_id, interval_min in phi_rows:
+            rid_phi_rows_map.setdefault(route_id, []).append(
+                (serial_no, it_is_return, stop_id, interval_min)
+            )
+
+        rid_removed_sno_set_map = {}
+        for row in removed_phi_rows:
+            rid_removed_sno_set_map.setdefault(row[0], set()).add(row[1])
+            rid_phi_rows_map.setdefault(row[0], [])
+
+        for route_id, route_phi_rows in rid_phi_rows_map.iteritems():
+
+            rno = self._rid_rno_map.get(route_id)
+            if rno is None:
+                rno = self._rid_rno_map[route_id] = len(self._routes)
+                self._routes.append(_Route(route_id, None))
+            route = self._routes[rno]
+
+            self._remove_postings(rno, route)
+
+            sno_row_map = {row[0]: row for row in route.get_phis()}
+            for serial_no in rid_removed_sno_set_map.get(route_id, ()):
+                sno_row_map.pop(serial_no, None)
+            sno_row_map.update((row[0], row) for row in route_phi_rows)
+            route.set_phis(sno_row_map.itervalues())
+
+            self._add_postings(rno, route)
+
+    def _add_postings(self, rno, route):
+        for pos, stop_id in enumerate(route.stop_ids):
+            postings = self._sid_postings_map.get(stop_id)
+            if postings is None:
+                postings = self._sid_postings_map[stop_id] = array('l')
+            postings.append(rno << _POS_BITS | pos)
+
+    def _remove_postings(self, rno, route):
+        for stop_id in set(route.stop_ids):
+            postings = self._sid_postings_map.get(stop_id)
+            if postings is None:
+                continue
+            postings = array('l', (
+                posting for posting in postings
+                if posting >> _POS_BITS != rno
+            ))
+            if postings:
+                self._sid_postings_map[stop_id] = postings
+            else:
+                del self._sid_postings_map[stop_id]
+
+    def update_interval_mins(self, rows):
+
+        # rows: [(route_id, serial_no, interval_min), ...]
+
+        with self._lock:
+            for route_id, serial_no, interval_min in rows:
+                rno = self._rid_rno_map.get(route_id)
+                if rno is None:
+                    continue
+                route = self._routes[rno]
+                pos = route.find_pos(serial_no)
+                if pos >= 0:
+                    route.interval_mins[pos] = _to_float(interval_min)
+                    route.invalidate_cum_mins()
+
+    def _group_by_route(self, stop_ids):
+
+        # -> {route_no: [position, ...]}
+
+        rno_poss_map = {}
+        for stop_id in stop_ids:
+            for posting in self._sid_postings_map.get(int(stop_id), ()):
+                rno_poss_map.setdefault(posting >> _POS_BITS, []).append(
+                    posting & _POS_MASK
+                )
+
+        return rno_poss_map
+
+    def _make_plan_dict(self, route, orig_pos, dest_pos):
+        return {
+            'route_id'          : route.id,
+            'route_name'        : route.name,
+            'orig_phi_serial_no': route.serial_nos[orig_pos],
+            'orig_phi_is_return': bool(route.it_is_returns[orig_pos]),
+            'orig_stop_id'      : route.stop_ids[orig_pos],
+            'orig_stop_name'    : self._sid_sname_map.get(
+                route.stop_ids[orig_pos]
+            ),
+            'dest_phi_serial_no': route.serial_nos[dest_pos],
+            'dest_phi_is_return': bool(route.it_is_returns[dest_pos]),
+            'dest_stop_id'      : route.stop_ids[dest_pos],
+            'dest_stop_name'    : self._sid_sname_map.get(
+                route.stop_ids[dest_pos]
+            )
+        }
+
+    def find_direct(self, orig_stop_ids, dest_stop_ids):
+
+        # the same as the sql of mrbus.model.query_plans: on each route, the
+        # pair of an orig and a dest which has the fewest stops between
+
+        plan_ds = []
+
+        with self._lock:
+
+            rno_orig_poss_map = self._group_by_route(orig_stop_ids)
+            rno_dest_poss_map = self._group_by_route(dest_stop_ids)
+
+            for rno, orig_poss in rno_orig_poss_map.iteritems():
+
+                dest_poss = rno_dest_poss_map.get(rno)
+                if not dest_poss:
+                    continue
+
+                # the positions are in the order of serial_no
+                best_pair = None
+                for orig_pos in orig_poss:
+                    for dest_pos in dest_poss:
+                        if dest_pos <= orig_pos:
+                            continue
+                        if (
+                            best_pair is None or
+                            dest_pos-orig_pos < best_pair[1]-best_pair[0]
+                        ):
+                            best_pair = (orig_pos, dest_pos)
+
+                if best_pair is not None:
+                    plan_ds.append(
+                        self._make_plan_dict(self._routes[rno], *best_pair)
+                    )
+
+        plan_ds.sort(key=lambda d: d['route_id'])
+
+        return plan_ds
+
+    def _make_leg_dict(self, rno, from_pos, to_pos):
+        route = self._routes[rno]
+        leg_d = self._make_plan_dict(route, from_pos, to_pos)
+        leg_d['driving_min'] = route.get_driving_min(from_pos, to_pos)
+        return leg_d
+
+    def _spread(self, stop_ids, is_forward):
+
+        # the stops reachable from stop_ids by one route (is_forward), or the
+        # stops which reach stop_ids by one route; the best one of each
+        # (stop, route) is kept
+        #
+        # -> {stop_id: [(driving_min, route_no, from_pos, to_pos), ...]}
+
+        rsid_entry_map = {}
+
+        for rno, poss in self._group_by_route(stop_ids).iteritems():
+
+            route = self._routes[rno]
+            cum_mins = route.get_cum_mins()
+            route_stop_ids = route.stop_ids
+
+            for pos in poss:
+
+                if is_forward:
+                    other_poss = xrange(pos+1, len(route_stop_ids))
+                else:
+                    other_poss = xrange(pos)
+
+                for other_pos in other_poss:
+
+                    if is_forward:
+                        entry = (
+                            cum_mins[other_pos]-cum_mins[pos],
+                            rno, pos, other_pos
+                        )
+                    else:
+                        entry = (
+                            cum_mins[pos]-cum_mins[other_pos],
+                            rno, other_pos, pos
+                        )
+
+                    key = (route_stop_ids[other_pos], rno)
+                    last_entry = rsid_entry_map.get(key)
+                    if last_entry is None or entry < last_entry:
+                        rsid_entry_map[key] = entry
+
+        sid_entries_map = {}
+        for (stop_id, _), entry in rsid_entry_map.iteritems():
+            sid_entries_map.setdefault(stop_id, []).append(entry)
+
+        return sid_entries_map
+
+    def _find_one_transfer_plans(self, sid_fentries_map, sid_bentries_map):
+
+        # fentry: forward entry; bentry: backward entry
+        # -> {(route_no, ...): (total_min, legs)}
+
+        rnos_plan_map = {}
+
+        for stop_id, fentries in sid_fentries_map.iteritems():
+
+            bentries = sid_bentries_map.get(stop_id)
+            if not bentries:
+                continue
+
+            for fentry in fentries:
+                for bentry in bentries:
+
+                    if fentry[1] == bentry[1]:
+                        # the same route, it's a direct one
+                        continue
+
+                    rnos = (fentry[1], bentry[1])
+                    total_min = fentry[0]+bentry[0]
+
+                    last_plan = rnos_plan_map.get(rnos)
+                    if last_plan is None or total_min < last_plan[0]:
+                        rnos_plan_map[rnos] = (
+                            total_min,
+                            [fentry[1:], bentry[1:]]
+                        )
+
+        return rnos_plan_map
+
+    def _find_two_transfer_plans(self, sid_fentries_map, sid_bentries_map):
+
+        # the middle leg is found by a scan of each route which touches both
+        # of the sides, keeping the best boarding so far; it's linear in the
+        # length of these routes, instead of the pairs of the stops
+
+        sid_fentry_map = {
+            stop_id: min(fentries)
+            for stop_id, fentries in sid_fentries_map.iteritems()
+        }
+        sid_bentry_map = {
+            stop_id: min(bentries)
+            for stop_id, bentries in sid_bentries_map.iteritems()
+        }
+
+        mid_rnos = (
+            set(self._group_by_route(sid_fentry_map)) &
+            set(self._group_by_route(sid_bentry_map))
+        )
+
+        rnos_plan_map = {}
+
+        for rno in mid_rnos:
+
+            route = self._routes[rno]
+            cum_mins = route.get_cum_mins()
+
+            # (sum of the first leg - cum_min at boarding, fentry, pos)
+            best_boarding = None
+
+            for pos, stop_id in enumerate(route.stop_ids):
+
+                bentry = sid_bentry_map.get(stop_id)
+                if (
+                    best_boarding is not None and
+                    bentry is not None and
+                    bentry[1] != rno and
+                    bentry[1] != best_boarding[1][1]
+                ):
+                    total_min = best_boarding[0]+cum_mins[pos]+bentry[0]
+                    fentry = best_boarding[1]
+                    rnos = (fentry[1], rno, bentry[1])
+                    last_plan = rnos_plan_map.get(rnos)
+                    if last_plan is None or total_min < last_plan[0]:
+                        rnos_plan_map[rnos] = (
+                            total_min,
+                            [
+                                fentry[1:],
+                                (rno, best_boarding[2], pos),
+                                bentry[1:]
+                            ]
+                        )
+
+                fentry = sid_fentry_map.get(stop_id)
+                if fentry is not None and fentry[1] != rno:
+                    val = fentry[0]-cum_mins[pos]
+                    if best_boarding is None or val < best_boarding[0]:
+                        best_boarding = (val, fentry, pos)
+
+        return rnos_plan_map
+
+    def find_plans(
+        self, orig_stop_ids, dest_stop_ids, max_transfer_n=1, limit=10
+    ):
+
+        # the plans with 1 to max_transfer_n (at most 2) transfers, ranked by
+        # the summed driving_min of the legs; a transfer is at the same stop.
+        # each combination of routes appears once, by its best legs.
+
+        with self._lock:
+
+            sid_fentries_map = self._spread(orig_stop_ids, is_forward=True)
+            sid_bentries_map = self._spread(dest_stop_ids, is_forward=False)
+
+            rnos_plan_map = self._find_one_transfer_plans(
+                sid_fentries_map,
+                sid_bentries_map
+            )
+            if max_transfer_n >= 2:
+                rnos_plan_map.update(self._find_two_transfer_plans(
+                    sid_fentries_map,
+                    sid_bentries_map
+                ))
+
+            plans = sorted(rnos_plan_map.itervalues())[:limit]
+
+            plan_ds = []
+            for total_min, legs in plans:
+                plan_ds.append({
+                    'transfer_n': len(legs)-1,
+                    'total_min' : total_min,
+                    'legs'      : [
+                        self._make_leg_dict(rno, from_pos, to_pos)
+                        for rno, from_pos, to_pos in legs
+                    ]
+                })
+
+        return plan_ds
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'route_n'  : len(self._routes),
+                'stop_n'   : len(self._sid_postings_map),
+                'phi_n'    : sum(len(route) for route in self._routes),
+                'loaded_ts': self.loaded_ts
+            }
+
+if __name__ == '__main__':
+
+    from pprint import pprint
+
+    index = PhiIndex()
+    index.load(
+        [('tp_1', u'1'), ('tp_2', u'2')],
+        [(1, u'A'), (2, u'B'), (3, u'C')],
+        [
+            ('tp_1', 0, False, 1, None),
+            ('tp_1', 1, False, 2, 5),
+            ('tp_1', 2, True, 3, 6),
+            ('tp_2', 0, False, 3, 10),
+            ('tp_2', 1, False, 1, 10),
+        ]
+    )
+
+    pprint(index.find_direct([1], [3]))
+
+    index.patch([], [('tp_2', 2, False, 2, 12)])
+    index.update_interval_mins([('tp_1', 0, 4)])
+    pprint(index.find_direct([1], [2]))
+    index.patch([], [], removed_phi_rows=[('tp_2', 2, 2)])
+    pprint(index.find_direct([1], [2]))
+    pprint(index.get_stats())
+
+    index.patch(
+        [('tp_3', u'3'), ('tp_4', u'4')],
+        [
+            ('tp_3', 0, False, 2, None),
+            ('tp_3', 1, False, 4, 3),
+            ('tp_4', 0, False, 4, None),
+            ('tp_4', 1, False, 5, 7),
+        ],
+        [(4, u'D'), (5, u'E')]
+    )
+    pprint(index.find_plans([1], [5], max_transfer_n=2))
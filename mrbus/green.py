@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# a gevent-based fetch engine, the non-blocking alternative of mrbus.pool.Pool
+#
+# we are on Python 2, so there is no asyncio; gevent gives us the same event
+# loop model. it must patch before the others import socket and threading,
+# so import this module first, or just run it:
+#
+#     $ python -m mrbus.green sync_stops_n_phis_of_all_routes
+#
+
+from gevent import monkey
+monkey.patch_all()
+
+from gevent.pool import Pool as _GreenletPool
+from mrbus.pool import Future, _run_to_future
+from mrbus.gov import set_sessions_per_host
+from mrbus import model
+
+class Engine(object):
+
+    # it has the same interface as mrbus.pool.Pool, but each task is a
+    # greenlet, so hundreds of requests can be in flight at once.
+    #
+    # after patching, the per-host session pools in mrbus.gov block
+    # cooperatively, so they are the per-host concurrency limit here.
+
+    def __init__(self, n=500, n_per_host=50):
+        self._greenlet_pool = _GreenletPool(n)
+        set_sessions_per_host(n_per_host)
+
+    def join(self):
+        self._greenlet_pool.join()
+
+    def apply_async(self, func, args=None, kwds=None):
+        # it blocks when all of the n greenlets are busy
+        future = Future()
+        self._greenlet_pool.spawn(_run_to_future, future, func, args, kwds)
+        return future
+
+def sync_routes_on_all_route_indexes():
+    model.sync_routes_on_all_route_indexes(pool=Engine())
+
+def sync_stops_n_phis_of_all_routes(n=500, n_per_host=50, chunk_size=1000):
+    model.sync_stops_n_phis_of_all_routes(
+        pool = Engine(n, n_per_host),
+        chunk_size = chunk_size
+    )
+
+def sync_etas_of_all_routes(n=500, n_per_host=50, chunk_size=1000):
+    model.sync_etas_of_all_routes(
+        pool = Engine(n, n_per_host),
+        chunk_size = chunk_size
+    )
+
+if __name__ == '__main__':
+
+    import clime
+    clime.start(debug=True)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# the recent eta snapshots of each phi in memory; the full history is in the
+# eta_history table, see mrbus.model
+#
+# a route keeps a ring of the snapshot timestamps, and each phi of it keeps a
+# ring of the values in the same slots, as an array of shorts:
+#
+# 1. waiting_min if the status_code is 0,
+# 2. -status_code otherwise,
+# 3. _MISSING if the phi isn't in that snapshot.
+
+from array import array
+from threading import Lock
+
+_MISSING = -32768
+
+def encode_eta(status_code, waiting_min):
+    if status_code:
+        return -status_code
+    return waiting_min
+
+def decode_eta(val):
+    # -> (status_code, waiting_min)
+    if val < 0:
+        return (-val, None)
+    return (0, val)
+
+class _RouteRing(object):
+
+    def __init__(self, size):
+        self.size = size
+        # the next slot
+        self.cursor = 0
+        self.n = 0
+        self.tss = array('d', [0.])*size
+        self.sno_vals_map = {}
+
+    def append(self, ts, sno_val_pairs):
+
+        cursor = self.cursor
+        self.tss[cursor] = ts
+
+        # clear the slot of the phis not in this snapshot
+        for vals in self.sno_vals_map.itervalues():
+            vals[cursor] = _MISSING
+
+        for sno, val in sno_val_pairs:
+            vals = self.sno_vals_map.get(sno)
+            if vals is None:
+                vals = self.sno_vals_map[sno] = (
+                    array('h', [_MISSING])*self.size
+                )
+            vals[cursor] = val
+
+        self.cursor = (cursor+1) % self.size
+        self.n = min(self.n+1, self.size)
+
+    def get(self, sno):
+
+        # -> [(ts, status_code, waiting_min), ...] from the oldest
+
+        vals = self.sno_vals_map.get(sno)
+        if vals is None:
+            return []
+
+        triples = []
+        for i in xrange(self.n):
+            slot = (self.cursor-self.n+i) % self.size
+            val = vals[slot]
+            if val == _MISSING:
+                continue
+            triples.append((self.tss[slot], )+decode_eta(val))
+
+        return triples
+
+class EtaRingBuffer(object):
+
+    # it is thread-safe
+
+    def __init__(self, size=60):
+        self._size = size
+        self._rid_ring_map = {}
+        self._lock = Lock()
+
+    def append(self, route_id, ts, sno_val_pairs):
+
+        # sno_val_pairs: [(serial_no, encode_eta(...)), ...] of a snapshot
+
+        with self._lock:
+            ring = self._rid_ring_map.get(route_id)
+            if ring is None:
+                ring = self._rid_ring_map[route_id] = _RouteRing(self._size)
+            ring.append(ts, sno_val_pairs)
+
+    def get(self, route_id, serial_no):
+        with self._lock:
+            ring = self._rid_ring_map.get(route_id)
+            if ring is None:
+                return []
+            return ring.get(serial_no)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'route_n': len(self._rid_ring_map),
+                'phi_n'  : sum(
+                    len(ring.sno_vals_map)
+                    for ring in self._rid_ring_map.itervalues()
+                ),
+                'size'   : self._size
+            }
+
+if __name__ == '__main__':
+
+    buf = EtaRingBuffer(3)
+    for ts in range(5):
+        buf.append('tp_1', ts, [
+            (0, encode_eta(0, 10-ts)),
+            (1, encode_eta(2, None))
+        ])
+    buf.append('tp_1', 5, [(0, encode_eta(0, 3))])
+
+    print buf.get('tp_1', 0)
+    print buf.get('tp_1', 1)
+    print buf.get_stats()
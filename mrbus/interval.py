@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# the vectorized derivation and smoothing of interval_min
+#
+# a sync passes the phis of all of the routes in a chunk as flat arrays in
+# the order of (route, serial_no), with is_firsts marking where a route
+# starts, so the cost is a few numpy ops instead of a loop per stop.
+
+import numpy as np
+
+def derive_interval_mins(waiting_mins, is_firsts):
+
+    # interval_min is the time from last stop to this stop, so the driving_min
+    # will be sum(interval_min[here+1:there+1]); nan if unknown
+    #
+    # waiting_mins: float array, nan if not running
+
+    interval_mins = np.full(len(waiting_mins), np.nan)
+
+    if len(waiting_mins) > 1:
+        diffs = waiting_mins[1:]-waiting_mins[:-1]
+        with np.errstate(invalid='ignore'):
+            # a bus between, or a bus already gone, is not the interval
+            interval_mins[1:] = np.where(diffs >= 0, diffs, np.nan)
+
+    interval_mins[is_firsts] = np.nan
+
+    return interval_mins
+
+def smooth_interval_mins(
+    last_interval_mins, interval_mins,
+    alpha=0.5, outlier_ratio=3., outlier_floor_min=2.
+):
+
+    # an ewma of the new ones into the last ones
+    #
+    # a new one farther than outlier_ratio*max(last, outlier_floor_min) from
+    # the last one is clipped to that bound before blending, so a jam moves it
+    # only a little, but a lasting change still converges.
+
+    last = last_interval_mins
+    new = interval_mins
+
+    bound = outlier_ratio*np.maximum(last, outlier_floor_min)
+    clipped = np.clip(new, last-bound, last+bound)
+
+    blended = alpha*clipped+(1-alpha)*last
+
+    return np.where(
+        np.isnan(last),
+        new,
+        np.where(np.isnan(new), last, blended)
+    )
+
+if __name__ == '__main__':
+
+    waiting_mins = np.array([1, 3, 4, np.nan, 5, 2, 4, 10], dtype=float)
+    is_firsts = np.array([1, 0, 0, 0, 0, 1, 0, 0], dtype=bool)
+
+    interval_mins = derive_interval_mins(waiting_mins, is_firsts)
+    print interval_mins
+
+    last_interval_mins = np.array(
+        [np.nan, 1, 1, 1, np.nan, 2, 2, 1],
+        dtype = float
+    )
+    print smooth_interval_mins(last_interval_mins, interval_mins)
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# the sharded sweeps: the workers, in any processes or machines, lease the due
+# routes in batches from the route_lease table, so a sweep scales with them
+#
+# 1. a batch is taken by `for update skip locked`, so the workers never wait
+#    on each other's rows,
+# 2. a lease expires after lease_sec, and is renewed by a heartbeat while the
+#    batch is syncing, so a crashed worker's routes are taken after it,
+# 3. a synced route is due again after interval_sec, and a failed one after
+#    retry_sec.
+#
+# the timestamps are of the db's clock, so the machines' don't matter.
+#
+#     $ python -m mrbus.lease refill etas
+#     $ python -m mrbus.lease work etas --interval-sec=60
+#
+
+import os
+import socket
+from time import time, sleep
+from threading import Event
+from contextlib import contextmanager
+from mrbus.util import debug
+from mrbus.pool import spawn
+from mrbus.conn import db, keep_conns
+from mrbus import model, metrics
+
+_SWEEP_ETAS = 'etas'
+_SWEEP_STOPS_N_PHIS = 'stops_n_phis'
+
+def _get_default_worker():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+def refill(sweep):
+
+    # enqueue the routes on index as due, and dequeue the others
+
+    with db as cur:
+
+        cur.execute('''
+            insert into
+                route_lease (sweep, route_id, due_ts)
+            select
+                %s, id, now()
+            from
+                route
+            where
+                on_index = true
+            on conflict
+                (sweep, route_id)
+            do nothing
+        ''', (sweep, ))
+        added_n = cur.rowcount
+
+        cur.execute('''
+            delete from
+                route_lease
+            using
+                route
+            where
+                route_lease.sweep = %s and
+                route_lease.route_id = route.id and
+                route.on_index = false
+        ''', (sweep, ))
+        removed_n = cur.rowcount
+
+    debug('{} added, {} removed'.format(added_n, removed_n))
+
+def lease(sweep, worker, batch_size=100, lease_sec=300):
+
+    # -> the ids of the routes leased, the most overdue first; the expired
+    #    leases are taken as due
+
+    with db as cur:
+        cur.execute('''
+            with leasable as (
+                select
+                    route_id
+                from
+                    route_lease
+                where
+                    sweep = %(sweep)s and
+                    due_ts <= now() and
+                    (lease_ts is null or lease_ts < now())
+                order by
+                    due_ts
+                limit
+                    %(batch_size)s
+                for update skip locked
+            )
+            update
+                route_lease
+            set
+                worker   = %(worker)s,
+                lease_ts = now()+%(lease_sec)s*interval '1 second'
+            from
+                leasable
+            where
+                route_lease.sweep = %(sweep)s and
+                route_lease.route_id = leasable.route_id
+            returning
+                route_lease.route_id
+        ''', {
+            'sweep'     : sweep,
+            'worker'    : worker,
+            'batch_size': batch_size,
+            'lease_sec' : lease_sec
+        })
+        rids = [rid for rid, in cur]
+
+    metrics.inc('mrbus_lease_routes_total', len(rids), sweep=sweep, op='lease')
+
+    return rids
+
+def renew(sweep, worker, route_ids, lease_sec=300):
+
+    # -> the ids of the routes whose leases are still held
+
+    if not route_ids:
+        return []
+
+    with db as cur:
+        cur.execute('''
+            update
+                route_lease
+            set
+                lease_ts = now()+%s*interval '1 second'
+            where
+                sweep = %s and
+                route_id in %s and
+                worker = %s
+            returning
+                route_id
+        ''', (lease_sec, sweep, tuple(route_ids), worker))
+        return [rid for rid, in cur]
+
+def _finish(sweep, worker, route_ids, after_sec, it_is_synced):
+
+    # a lease taken by another worker after expiring is left to it
+
+    if not route_ids:
+        return
+
+    with db as cur:
+        cur.execute('''
+            update
+                route_lease
+            set
+                due_ts    = now()+%s*interval '1 second',
+                worker    = null,
+                lease_ts  = null,
+                synced_ts = case when %s then now() else synced_ts end
+            where
+                sweep = %s and
+                route_id in %s and
+                worker = %s
+        ''', (after_sec, it_is_synced, sweep, tuple(route_ids), worker))
+
+    metrics.inc(
+        'mrbus_lease_routes_total', len(route_ids),
+        sweep = sweep,
+        op = 'complete' if it_is_synced else 'release'
+    )
+
+def complete(sweep, worker, route_ids, interval_sec=60):
+    _finish(sweep, worker, route_ids, interval_sec, True)
+
+def release(sweep, worker, route_ids, retry_sec=30):
+    _finish(sweep, worker, route_ids, retry_sec, False)
+
+@contextmanager
+def _heartbeat(sweep, worker, route_ids, lease_sec):
+
+    # renew the leases every third of lease_sec until the block exits; yields
+    # the set of the ids still held, which drops the lost ones
+    #
+    # a failed renewal is retried at the next beat, as the leases are still
+    # held until they expire
+
+    held_rid_set = set(route_ids)
+    stop_event = Event()
+
+    def beat():
+        while not stop_event.wait(lease_sec/3.):
+
+            try:
+                held_rids = renew(sweep, worker, held_rid_set, lease_sec)
+            except Exception as e:
+                metrics.inc('mrbus_lease_renewal_failures_total', sweep=sweep)
+                debug('{}: {}'.format(e.__class__.__name__, e))
+                continue
+
+            lost_rid_set = held_rid_set-set(held_rids)
+            if lost_rid_set:
+                debug('lost {} of {} leases'.format(
+                    len(lost_rid_set),
+                    len(route_ids)
+                ))
+                held_rid_set.difference_update(lost_rid_set)
+
+    future = spawn(beat)
+    try:
+        yield held_rid_set
+    finally:
+        stop_event.set()
+        future.result()
+
+def _sync(sweep, route_ids, pool, budget_sec):
+
+    # -> the ids of the routes synced
+
+    if sweep == _SWEEP_ETAS:
+        return list(model.sync_etas_of_routes(
+            route_ids,
+            pool = pool,
+            budget_sec = budget_sec
+        ))
+
+    if sweep == _SWEEP_STOPS_N_PHIS:
+        return model.sync_stops_n_phis_of_routes(
+            route_ids,
+            pool = pool,
+            budget_sec = budget_sec
+        )
+
+    raise ValueError('unknown sweep: {!r}'.format(sweep))
+
+def work_once(
+    sweep, worker, pool=None, batch_size=100, lease_sec=300,
+    interval_sec=60, retry_sec=30
+):
+
+    # -> the number of the routes leased
+
+    rids = lease(sweep, worker, batch_size, lease_sec)
+    if not rids:
+        return 0
+
+    # the budget is in the lease, so the heartbeat is only for the slow db
+    with _heartbeat(sweep, worker, rids, lease_sec) as held_rid_set:
+        try:
+            synced_rids = _sync(sweep, rids, pool, lease_sec*0.8)
+        except Exception as e:
+            debug('{}: {}'.format(e.__class__.__name__, e))
+            synced_rids = []
+
+    # the lost ones are another worker's now
+    synced_rid_set = set(synced_rids)
+    complete(
+        sweep, worker,
+        [rid for rid in rids if rid in held_rid_set and rid in synced_rid_set],
+        interval_sec
+    )
+    release(
+        sweep, worker,
+        [
+            rid for rid in rids
+            if rid in held_rid_set and rid not in synced_rid_set
+        ],
+        retry_sec
+    )
+
+    return len(rids)
+
+def get_stats(sweep):
+    with db as cur:
+        cur.execute('''
+            select
+                count(*),
+                count(*) filter (where due_ts <= now()),
+                count(*) filter (where lease_ts >= now()),
+                count(*) filter (where lease_ts < now()),
+                count(distinct worker) filter (where lease_ts >= now())
+            from
+                route_lease
+            where
+                sweep = %s
+        ''', (sweep, ))
+        route_n, due_n, leased_n, expired_n, worker_n = cur.fetchone()
+    return {
+        'route_n'  : route_n,
+        'due_n'    : due_n,
+        'leased_n' : leased_n,
+        'expired_n': expired_n,
+        'worker_n' : worker_n
+    }
+
+def work(
+    sweep, worker=None, duration_sec=None, batch_size=100, lease_sec=300,
+    interval_sec=60, retry_sec=30, idle_sec=5
+):
+
+    # run a worker; start as many as you want, anywhere
+
+    keep_conns()
+
+    if worker is None:
+        worker = _get_default_worker()
+
+    start_ts = time()
+    route_n = 0
+
+    while duration_sec is None or time()-start_ts < duration_sec:
+
+        try:
+            n = work_once(
+                sweep, worker,
+                batch_size = batch_size,
+                lease_sec = lease_sec,
+                interval_sec = interval_sec,
+                retry_sec = retry_sec
+            )
+        except Exception as e:
+            # e.g., the db is down; the leases expire for the others
+            metrics.inc('mrbus_lease_batch_failures_total', sweep=sweep)
+            debug('{}: {}'.format(e.__class__.__name__, e))
+            n = 0
+
+        route_n += n
+
+        if not n:
+            sleep(idle_sec)
+
+    debug('{} swept {} routes in {:.3f}s'.format(
+        worker,
+        route_n,
+        time()-start_ts
+    ))
+
+if __name__ == '__main__':
+
+    import clime
+    clime.start(debug=True)
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# counters, latency histograms and gauges, exported as the prometheus text
+# format or a json snapshot
+#
+# it is disabled by default and every call returns at once then, so call
+# enable() in the entry point which wants them:
+#
+#     from mrbus import metrics
+#     metrics.enable()
+#     metrics.serve(9100)
+#
+# to alert when a sweep regresses, e.g.:
+#
+#     histogram_quantile(0.9, rate(mrbus_sweep_seconds_bucket[1h])) > 120
+#
+# ref: https://prometheus.io/docs/instrumenting/exposition_formats/
+
+import json
+from time import time
+from threading import Lock, Thread
+from bisect import bisect_left
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+is_enabled = False
+
+# in seconds
+_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 30, 60, 120, 300
+)
+
+_lock = Lock()
+# key: (name, ((label_name, label_val), ...))
+_key_counter_map = {}
+# histogram: [bucket_counts, sum, count]
+_key_histogram_map = {}
+_key_gauge_func_map = {}
+
+def _make_key(name, labels):
+    return (name, tuple(sorted(labels.iteritems())))
+
+def inc(name, n=1, **labels):
+
+    if not is_enabled:
+        return
+
+    key = _make_key(name, labels)
+    with _lock:
+        _key_counter_map[key] = _key_counter_map.get(key, 0)+n
+
+def observe(name, val, **labels):
+
+    if not is_enabled:
+        return
+
+    key = _make_key(name, labels)
+    with _lock:
+        histogram = _key_histogram_map.get(key)
+        if histogram is None:
+            histogram = _key_histogram_map[key] = [
+                [0]*(len(_BUCKETS)+1), 0, 0
+            ]
+        # the last one is +Inf
+        histogram[0][bisect_left(_BUCKETS, val)] += 1
+        histogram[1] += val
+        histogram[2] += 1
+
+def register_gauge(name, func, **labels):
+    # func is called when exporting
+    with _lock:
+        _key_gauge_func_map[_make_key(name, labels)] = func
+
+class _Timer(object):
+
+    def __init__(self, name, labels):
+        self._name = name
+        self._labels = labels
+
+    def __enter__(self):
+        self._start_ts = time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        observe(self._name, time()-self._start_ts, **self._labels)
+
+class _NoopTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+_noop_timer = _NoopTimer()
+
+def timed(name, **labels):
+    if not is_enabled:
+        return _noop_timer
+    return _Timer(name, labels)
+
+# db
+
+def _create_timed_cursor_class():
+
+    from psycopg2.extensions import cursor
+
+    class _TimedCursor(cursor):
+
+        # it observes mrbus_db_statement_seconds by the leading keyword
+
+        def _time(self, method, kind, *args, **kargs):
+            with timed(
+                'mrbus_db_statement_seconds',
+                method = method.__name__,
+                kind = kind
+            ):
+                return method(self, *args, **kargs)
+
+        def execute(self, sql, *args, **kargs):
+            return self._time(
+                cursor.execute, _get_kind(sql),
+                sql, *args, **kargs
+            )
+
+        def executemany(self, sql, *args, **kargs):
+            return self._time(
+                cursor.executemany, _get_kind(sql),
+                sql, *args, **kargs
+            )
+
+        def copy_from(self, *args, **kargs):
+            return self._time(cursor.copy_from, 'copy', *args, **kargs)
+
+    return _TimedCursor
+
+def _get_kind(sql):
+    words = sql.split(None, 1)
+    if words:
+        return words[0].lower()
+    return ''
+
+def enable():
+
+    global is_enabled
+    is_enabled = True
+
+    from mrbus.conn import db
+    timed_cursor_class = _create_timed_cursor_class()
+    db.getcur = lambda conn: conn.cursor(cursor_factory=timed_cursor_class)
+
+def disable():
+
+    global is_enabled
+    is_enabled = False
+
+    from mrbus.conn import db
+    db.getcur = lambda conn: conn.cursor()
+
+def reset():
+    with _lock:
+        _key_counter_map.clear()
+        _key_histogram_map.clear()
+
+# export
+
+def get_counter(name, **labels):
+    return _key_counter_map.get(_make_key(name, labels), 0)
+
+def get_histogram_sum(name, **labels):
+    # sum up all of the label sets if labels are not given
+    with _lock:
+        return sum(
+            histogram[1]
+            for (key_name, key_labels), histogram
+            in _key_histogram_map.iteritems()
+            if key_name == name and (
+                not labels or key_labels == _make_key(name, labels)[1]
+            )
+        )
+
+def _get_gauge_pairs():
+
+    with _lock:
+        key_func_pairs = _key_gauge_func_map.items()
+
+    key_val_pairs = []
+    for key, func in key_func_pairs:
+        try:
+            key_val_pairs.append((key, func()))
+        except Exception:
+            pass
+
+    return key_val_pairs
+
+def get_snapshot():
+
+    with _lock:
+
+        counter_ds = [
+            {'name': name, 'labels': dict(labels), 'value': val}
+            for (name, labels), val in _key_counter_map.iteritems()
+        ]
+
+        histogram_ds = [
+            {
+                'name'   : name,
+                'labels' : dict(labels),
+                'buckets': zip(_BUCKETS+('+Inf', ), bucket_counts),
+                'sum'    : sum_,
+                'count'  : count
+            }
+            for (name, labels), (bucket_counts, sum_, count)
+            in _key_histogram_map.iteritems()
+        ]
+
+    gauge_ds = [
+        {'name': name, 'labels': dict(labels), 'value': val}
+        for (name, labels), val in _get_gauge_pairs()
+    ]
+
+    return {
+        'ts'        : time(),
+        'counters'  : counter_ds,
+        'histograms': histogram_ds,
+        'gauges'    : gauge_ds
+    }
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return u'{{{}}}'.format(u','.join(
+        u'{}="{}"'.format(
+            k,
+            unicode(v).replace('\\', '\\\\').replace('"', '\\"')
+        )
+        for k, v in labels
+    ))
+
+def _append_type_line(lines, typed_name_set, name, type_):
+    # once per family, before its first sample; the samples are sorted, so a
+    # family is in a row
+    if name not in typed_name_set:
+        typed_name_set.add(name)
+        lines.append(u'# TYPE {} {}'.format(name, type_))
+
+def render_prometheus():
+
+    lines = []
+    typed_name_set = set()
+
+    with _lock:
+
+        for (name, labels), val in sorted(_key_counter_map.iteritems()):
+            _append_type_line(lines, typed_name_set, name, 'counter')
+            lines.append(u'{}{} {}'.format(name, _format_labels(labels), val))
+
+        for (name, labels), (bucket_counts, sum_, count) in sorted(
+            _key_histogram_map.iteritems()
+        ):
+            _append_type_line(lines, typed_name_set, name, 'histogram')
+            cumulative_n = 0
+            for le, n in zip(_BUCKETS+('+Inf', ), bucket_counts):
+                cumulative_n += n
+                lines.append(u'{}_bucket{} {}'.format(
+                    name,
+                    _format_labels(labels+(('le', le), )),
+                    cumulative_n
+                ))
+            lines.append(u'{}_sum{} {}'.format(
+                name,
+                _format_labels(labels),
+                sum_
+            ))
+            lines.append(u'{}_count{} {}'.format(
+                name,
+                _format_labels(labels),
+                count
+            ))
+
+    for (name, labels), val in sorted(_get_gauge_pairs()):
+        _append_type_line(lines, typed_name_set, name, 'gauge')
+        lines.append(u'{}{} {}'.format(name, _format_labels(labels), val))
+
+    lines.append(u'')
+
+    return u'\n'.join(lines).encode('utf-8')
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+
+        if self.path == '/metrics':
+            content_type = 'text/plain; version=0.0.4'
+            body = render_prometheus()
+        elif self.path == '/metrics.json':
+            content_type = 'application/json'
+            body = json.dumps(get_snapshot())
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def serve(port=9100, host='127.0.0.1'):
+
+    # serves /metrics and /metrics.json on a daemon thread
+
+    server = HTTPServer((host, port), _MetricsHandler)
+
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+if __name__ == '__main__':
+
+    enable()
+
+    inc('mrbus_test_total', host='example.com')
+    with timed('mrbus_test_seconds', phase='sleep'):
+        pass
+    register_gauge('mrbus_test_gauge', lambda: 42)
+
+    print render_prometheus()
+    print json.dumps(get_snapshot(), indent=2)
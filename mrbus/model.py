@@ -2,36 +2,98 @@
 # -*- coding: utf-8 -*-
 
 from time import time
+from copy import deepcopy
+from itertools import chain
 from mosql.db import all_to_dicts
-from mrbus.util import debug, get_now_dt, escape_like_operand
-from mrbus.pool import Pool
+from datetime import datetime, timedelta
+from threading import Lock
+from mrbus.util import (
+    debug, get_now_dt, ensure_unicode, escape_like_operand, copy_rows
+)
+from mrbus.exc import RouteIDError
+from mrbus.pool import Pool, wait
+from mrbus.cache import LRUCache
+from mrbus.graph import PhiIndex
+from mrbus.search import StopNameIndex, iter_grams
+from mrbus.history import EtaRingBuffer, encode_eta
+from mrbus.record import Phi, Eta
 from mrbus.gov import *
+from mrbus.gov import set_sessions_per_host
 from mrbus.conn import db
+from mrbus import metrics
 
-_pool = Pool()
+_POOL_SIZE = 3
 
-def sync_routes_on_all_route_indexes():
+# one keep-alive session per worker per host
+set_sessions_per_host(_POOL_SIZE)
+
+# the workers are started by the first sync, not on import, so the queries
+# don't pay for them
+_pool = None
+_pool_lock = Lock()
+
+def _get_pool():
+
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = Pool(_POOL_SIZE)
+            metrics.register_gauge(
+                'mrbus_pool_queue_size',
+                _pool.get_queue_size
+            )
+            metrics.register_gauge(
+                'mrbus_pool_utilization',
+                _pool.get_utilization
+            )
+
+    return _pool
+
+def _observe_sweep(name, start_ts, networking_sec):
+
+    sec = time()-start_ts
+
+    metrics.observe('mrbus_sweep_seconds', sec, sweep=name)
+    metrics.observe(
+        'mrbus_sweep_networking_seconds', networking_sec,
+        sweep=name
+    )
+
+    debug('The {} sweep took {:.3f}s, {:.3f}s on networking.'.format(
+        name,
+        sec,
+        networking_sec
+    ))
+
+def _get_end_ts(start_ts, budget_sec):
+    if budget_sec is None:
+        return None
+    return start_ts+budget_sec
+
+def sync_routes_on_all_route_indexes(pool=None, budget_sec=None):
+
+    if pool is None:
+        pool = _get_pool()
 
     start_ts = time()
+    end_ts = _get_end_ts(start_ts, budget_sec)
 
     # set up
 
     # rc: region code (Taipei -> tp; NewTaipei -> nt)
     # ri: route index
     rc_ri_pairs = [
-        ('tp', TaipeiRouteIndex()),
-        ('nt', NewTaipeiRouteIndex())
+        ('tp', TaipeiRouteIndex(end_ts)),
+        ('nt', NewTaipeiRouteIndex(end_ts))
     ]
 
     # fetch them asyncly
     # the data will be cached in route index instance
 
-    for _, ri in rc_ri_pairs:
-        _pool.apply_async(ri.get_name_rid_map)
+    wait([pool.apply_async(ri.get_name_rid_map) for _, ri in rc_ri_pairs])
 
-    _pool.join()
-
-    debug('Took {:.3f}s on networking.'.format(time()-start_ts))
+    networking_sec = time()-start_ts
 
     # transform
 
@@ -62,9 +124,10 @@ def sync_routes_on_all_route_indexes():
         ''', (tuple(rid_rd_map), ))
 
         to_mark_on_index_false_rids = tuple(rid for rid, in cur)
-        debug('len(to_mark_on_index_false_rids) = {!r}'.format(
-            len(to_mark_on_index_false_rids)
-        ))
+        metrics.inc(
+            'mrbus_rows_total', len(to_mark_on_index_false_rids),
+            table='route', op='mark_off_index'
+        )
 
         if to_mark_on_index_false_rids:
             cur.execute('''
@@ -113,8 +176,14 @@ def sync_routes_on_all_route_indexes():
                 rd['created_ts'] = now_dt
                 to_insert_rds.append(rd)
 
-        debug('len(to_update_rds) = {!r}'.format(len(to_update_rds)))
-        debug('len(to_insert_rds) = {!r}'.format(len(to_insert_rds)))
+        metrics.inc(
+            'mrbus_rows_total', len(to_update_rds),
+            table='route', op='update'
+        )
+        metrics.inc(
+            'mrbus_rows_total', len(to_insert_rds),
+            table='route', op='insert'
+        )
 
         if to_update_rds:
             cur.executemany('''
@@ -135,9 +204,80 @@ def sync_routes_on_all_route_indexes():
                     (%(id)s, %(name)s, %(updated_ts)s, %(created_ts)s)
             ''', to_insert_rds)
 
-    debug('Took {:.3f}s.'.format(time()-start_ts))
+    # the renamed; the inserted ones have no phi yet. the index first, or the
+    # plans cached again still show the old names
+    if _phi_index.is_loaded():
+        _phi_index.patch([(rd['id'], rd['name']) for rd in to_update_rds], [])
+    _invalidate_plans_by_routes([rd['id'] for rd in to_update_rds])
+
+    _observe_sweep('routes', start_ts, networking_sec)
+
+def _query_route_hashes(route_ids):
+
+    # -> {route_id: ([page_hash of sec 0, 1], [api_hash of sec 0, 1])}
+
+    if not route_ids:
+        return {}
+
+    with db as cur:
+        cur.execute('''
+            select
+                id,
+                page_hashes,
+                api_hashes
+            from
+                route
+            where
+                id in %s
+        ''', (tuple(route_ids), ))
+        return {
+            rid: (page_hashes or [None, None], api_hashes or [None, None])
+            for rid, page_hashes, api_hashes in cur
+        }
+
+def _update_route_hashes(route_page_pairs_map, column):
+
+    # column: page_hashes or api_hashes
+
+    if not route_page_pairs_map:
+        return
 
-def _create_route_page_pair(route_id):
+    attr = column[:-2]
+
+    rids = []
+    hash0s = []
+    hash1s = []
+    for rid, rpagep in route_page_pairs_map.iteritems():
+        rids.append(rid)
+        hash0s.append(getattr(rpagep[0], attr))
+        hash1s.append(getattr(rpagep[1], attr))
+
+    with db as cur:
+        cur.execute('''
+            update
+                route
+            set
+                {column} = array[hashes.hash0, hashes.hash1]
+            from (
+                select
+                    unnest(%s::text[]) as id,
+                    unnest(%s::text[]) as hash0,
+                    unnest(%s::text[]) as hash1
+            ) as hashes
+            where
+                route.id = hashes.id
+        '''.format(column=column), (rids, hash0s, hash1s))
+
+def _is_unchanged(route_page_pair, with_page=True):
+    # the texts are the same as the last sync's
+    return not any(
+        (with_page and rpage.is_page_changed()) or rpage.is_api_changed()
+        for rpage in route_page_pair
+    )
+
+def _create_route_page_pair(route_id, end_ts=None, hashes=None):
+
+    # hashes: the ones of the last sync, see _query_route_hashes
 
     # rc : region code
     # rid: the route page's rid
@@ -153,15 +293,21 @@ def _create_route_page_pair(route_id):
     if route_page_class is None:
         raise RouteIDError('bad region code: {!r}'.format(rc))
 
+    if hashes is None:
+        hashes = ([None, None], [None, None])
+    page_hashes, api_hashes = hashes
+
     return (
-        route_page_class(rid, 0),
-        route_page_class(rid, 1)
+        route_page_class(rid, 0, end_ts, (page_hashes[0], api_hashes[0])),
+        route_page_class(rid, 1, end_ts, (page_hashes[1], api_hashes[1]))
     )
 
-def _query_route_ids_it(chunk_size=100):
-    # it: iterator
+def _seek_route_ids_it(chunk_size):
 
-    offset = 0
+    # keyset pagination on (created_ts, id), so the cost of a chunk doesn't
+    # grow with the offset, and the rows changed mid-sweep don't shift it
+
+    last_key = (datetime.min, u'')
 
     while True:
 
@@ -169,27 +315,82 @@ def _query_route_ids_it(chunk_size=100):
 
             cur.execute('''
                 select
+                    created_ts,
                     id
                 from
                     route
                 where
-                    on_index = true
+                    on_index = true and
+                    (created_ts, id) > (%s, %s)
                 order by
                     created_ts,
                     id
                 limit
                     %s
-                offset
-                    %s
-            ''', (chunk_size, offset))
+            ''', last_key+(chunk_size, ))
+
+            rows = cur.fetchall()
+
+        if not rows:
+            break
+
+        last_key = rows[-1]
 
-            route_ids = [route_id for route_id, in cur]
+        yield [route_id for _, route_id in rows]
+
+def _stream_route_ids_it(chunk_size):
+
+    # a server-side named cursor on its own connection; it is held over
+    # commit, so it reads a snapshot of the sweep's start without keeping a
+    # transaction open
+
+    conn = db.getconn()
+    cur = None
+
+    try:
+
+        cur = conn.cursor('route_ids', withhold=True)
+        cur.itersize = chunk_size
+
+        cur.execute('''
+            select
+                id
+            from
+                route
+            where
+                on_index = true
+            order by
+                created_ts,
+                id
+        ''')
+        conn.commit()
+
+        while True:
+
+            route_ids = [route_id for route_id, in cur.fetchmany(chunk_size)]
             if not route_ids:
                 break
 
             yield route_ids
 
-        offset += chunk_size
+    finally:
+        # also when the sweep stops early, or the pooled connection would
+        # keep the held cursor, and the next one fails as it already exists
+        if cur is not None:
+            try:
+                cur.close()
+                conn.commit()
+            except Exception as e:
+                debug('{}: {}'.format(e.__class__.__name__, e))
+        db.putconn(conn)
+
+def _query_route_ids_it(chunk_size=100, use_named_cursor=False):
+    # it: iterator
+
+    if use_named_cursor:
+        return _stream_route_ids_it(chunk_size)
+    else:
+        return _seek_route_ids_it(chunk_size)
 
 # nzscode: nonzero status code
 _ETA_NZSCODE_MAP = {
@@ -207,69 +408,199 @@ _NZSCODE_SMESSAGE_MAP = {
     4: u'今日未營運',
 }
 
-def _sync_stops_n_phis_on_route_page_pair(route_id, route_page_pair):
+# the weight of the new interval_min, as the former (last+new)/2
+_INTERVAL_ALPHA = 0.5
 
-    # merge stops first
+def _to_nan_if_none(x):
+    if x is None:
+        return float('nan')
+    return float(x)
 
-    sname_set = set()
-    for rpage in route_page_pair:
-        sname_set.update(rpage.get_idx_name_map().itervalues())
+def _fill_eta_columns(rs, raw_etas, key_imin_map):
 
-    with db as cur:
-        cur.execute('''
-            select
-                name, id
-            from
-                stop
-            where
-                name in %s
-        ''', (tuple(sname_set), ))
-        sname_sid_map = dict(cur)
+    # fill status_code, waiting_min and interval_min of the phis or etas
+    # records of a chunk by one vectorized pass
+    #
+    # rs: the records, in the order of (route_id, serial_no)
+    # raw_etas: the raw etas of rs
+    # key_imin_map: {(route_id, serial_no): the stored interval_min}
 
-    now_dt = get_now_dt()
-    # sds: stop dicts
-    to_insert_sds = []
-    for sname in sname_set:
-        if sname not in sname_sid_map:
-            to_insert_sds.append({
-                'name'     : sname,
-                'created_ts': now_dt
-            })
+    if not rs:
+        return
 
-    debug('len(to_insert_sds) = {!r}'.format(len(to_insert_sds)))
+    # numpy is only for the syncs
+    import numpy as np
+    from mrbus.interval import derive_interval_mins, smooth_interval_mins
 
-    if to_insert_sds:
+    raw_etas = np.array(raw_etas, dtype=float)
 
-        with db as cur:
+    status_codes = np.zeros(len(raw_etas), dtype=int)
+    for eta, nzscode in _ETA_NZSCODE_MAP.iteritems():
+        status_codes[raw_etas == eta] = nzscode
+    waiting_mins = np.where(status_codes == 0, raw_etas, np.nan)
 
-            cur.executemany('''
-                insert into
-                    stop (name, created_ts)
-                values
-                    (%(name)s, %(created_ts)s)
-            ''', to_insert_sds)
+    rids = [r.route_id for r in rs]
+    is_firsts = np.array(
+        [True]+[rids[i] != rids[i-1] for i in xrange(1, len(rids))],
+        dtype = bool
+    )
+
+    last_interval_mins = np.array([
+        _to_nan_if_none(key_imin_map.get((r.route_id, r.serial_no)))
+        for r in rs
+    ], dtype=float)
+
+    interval_mins = smooth_interval_mins(
+        last_interval_mins,
+        derive_interval_mins(waiting_mins, is_firsts),
+        alpha = _INTERVAL_ALPHA
+    )
+
+    for r, status_code, waiting_min, interval_min in zip(
+        rs,
+        status_codes.tolist(),
+        waiting_mins.tolist(),
+        interval_mins.round(2).tolist()
+    ):
+        r.status_code = status_code
+        if waiting_min != waiting_min:
+            r.waiting_min = None
+        else:
+            r.waiting_min = int(waiting_min)
+        if interval_min != interval_min:
+            r.interval_min = None
+        else:
+            r.interval_min = interval_min
+
+class _StopIDCache(object):
+
+    # a stop name -> id cache shared by the whole sync run
+    #
+    # it is warmed once from the stop table, then only the misses go to db,
+    # and they are inserted in batch. the stop ids never change once
+    # inserted, so the entries never go stale.
+
+    def __init__(self, maxsize=100000):
+        self._maxsize = maxsize
+        self._cache = LRUCache(maxsize)
+        # serializes the misses, so concurrent workers don't insert twice
+        self._lock = Lock()
+        self._is_warmed = False
+
+    def _warm(self):
 
+        with db as cur:
             cur.execute('''
                 select
                     name, id
                 from
                     stop
-                where
-                    name in %s
-            ''', (tuple(sd['name'] for sd in to_insert_sds), ))
+                order by
+                    id desc
+                limit
+                    %s
+            ''', (self._maxsize, ))
+            for sname, sid in cur:
+                self._cache.put(sname, sid)
 
-            sname_sid_map.update(cur)
+        debug('warmed {!r} stops'.format(len(self._cache)))
 
-    # then merge phi
+    def _merge_misses(self, snames):
+
+        with db as cur:
+
+            cur.execute('''
+                insert into
+                    stop (name, created_ts)
+                select
+                    unnest(%s::text[]), %s
+                on conflict
+                    (name)
+                do nothing
+                returning
+                    name, id
+            ''', (snames, get_now_dt()))
+            sname_sid_map = dict(cur)
+
+            metrics.inc(
+                'mrbus_rows_total', len(sname_sid_map),
+                table='stop', op='insert'
+            )
+
+            # inserted by others since we looked
+            others = [sname for sname in snames if sname not in sname_sid_map]
+            if others:
+                cur.execute('''
+                    select
+                        name, id
+                    from
+                        stop
+                    where
+                        name in %s
+                ''', (tuple(others), ))
+                sname_sid_map.update(cur)
+
+        # they are new to this process; index them, then drop the results
+        # which may miss them
+        if _stop_name_index.is_loaded():
+            _stop_name_index.add(
+                (sid, sname) for sname, sid in sname_sid_map.iteritems()
+            )
+        _invalidate_stops_by_names(sname_sid_map)
+
+        return sname_sid_map
+
+    def get_sid_map(self, snames):
+
+        sname_sid_map = {}
+
+        missed_snames = []
+        for sname in snames:
+            sid = self._cache.get(sname)
+            if sid is None:
+                missed_snames.append(sname)
+            else:
+                sname_sid_map[sname] = sid
+
+        if not missed_snames:
+            return sname_sid_map
+
+        with self._lock:
+
+            if not self._is_warmed:
+                self._warm()
+                self._is_warmed = True
+
+            to_merge_snames = []
+            for sname in missed_snames:
+                sid = self._cache.get(sname)
+                if sid is None:
+                    to_merge_snames.append(sname)
+                else:
+                    sname_sid_map[sname] = sid
 
-    # pk: phi primary key: (route_id, stop_id, serial_no)
-    pks = []
-    # pd: phi dict
-    pk_pd_map = {}
+            if to_merge_snames:
+                merged_sname_sid_map = self._merge_misses(to_merge_snames)
+                for sname, sid in merged_sname_sid_map.iteritems():
+                    self._cache.put(sname, sid)
+                sname_sid_map.update(merged_sname_sid_map)
+
+        return sname_sid_map
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._is_warmed = False
+
+_sid_cache = _StopIDCache()
+
+def _build_phis(route_id, route_page_pair, sname_sid_map):
+
+    phis = []
+    raw_etas = []
 
     serial_no = 0
     it_is_return = False
-    last_waiting_min = None
     for rpage in route_page_pair:
 
         idx_sname_map = rpage.get_idx_name_map()
@@ -280,181 +611,820 @@ def _sync_stops_n_phis_on_route_page_pair(route_id, route_page_pair):
 
         for idx in idxs:
 
-            eta = idx_eta_map[idx]
-
-            stop_id = sname_sid_map[idx_sname_map[idx]]
-            if eta in _ETA_NZSCODE_MAP:
-                status_code = _ETA_NZSCODE_MAP[eta]
-                waiting_min = None
-            else:
-                status_code = 0
-                waiting_min = eta
-
-            # interval_min is the time from last stop to this stop
-            # so the driving_min will be sum(interval_min[here+1:there+1])
-            if (
-                last_waiting_min is not None and
-                waiting_min is not None and
-                waiting_min >= last_waiting_min
-            ):
-                interval_min = waiting_min-last_waiting_min
-            else:
-                interval_min = None
-
-            pk = (route_id, serial_no)
-
-            pks.append(pk)
-            pk_pd_map[pk] = {
-                'route_id'    : route_id,
-                'serial_no'   : serial_no,
-                'it_is_return': it_is_return,
-                'stop_id'     : stop_id,
-                'status_code' : status_code,
-                'waiting_min' : waiting_min,
-                'interval_min': interval_min
-            }
+            phis.append(Phi(
+                route_id,
+                serial_no,
+                it_is_return,
+                idx,
+                sname_sid_map[idx_sname_map[idx]]
+            ))
+            raw_etas.append(idx_eta_map[idx])
 
             serial_no += 1
-            last_waiting_min = waiting_min
 
         it_is_return = not it_is_return
 
+    # the raw etas are for _fill_eta_columns
+    return (phis, raw_etas)
+
+_PHI_COLUMNS = Phi.__slots__
+
+def _merge_phis(phis):
+
+    # stage all of the rows by a COPY, then merge them by one statement,
+    # so the round trips don't grow with the number of stops
+
+    now_dt = get_now_dt()
+    for phi in phis:
+        phi.updated_ts = now_dt
+        phi.created_ts = now_dt
+
     with db as cur:
 
         cur.execute('''
+            create temp table
+                phi_stage (like phi)
+            on commit drop
+        ''')
+
+        copy_rows(cur, 'phi_stage', _PHI_COLUMNS, (
+            phi.to_row() for phi in phis
+        ))
+
+        cur.execute('''
+            insert into
+                phi ({columns})
             select
-                route_id, serial_no
+                {columns}
             from
+                phi_stage
+            on conflict
+                (route_id, serial_no)
+            do update set
+                it_is_return = excluded.it_is_return,
+                idx          = excluded.idx,
+                stop_id      = excluded.stop_id,
+                status_code  = excluded.status_code,
+                waiting_min  = excluded.waiting_min,
+                interval_min = excluded.interval_min,
+                updated_ts   = excluded.updated_ts
+            where
+                (
+                    phi.it_is_return,
+                    phi.idx,
+                    phi.stop_id,
+                    phi.status_code,
+                    phi.waiting_min,
+                    phi.interval_min
+                ) is distinct from (
+                    excluded.it_is_return,
+                    excluded.idx,
+                    excluded.stop_id,
+                    excluded.status_code,
+                    excluded.waiting_min,
+                    excluded.interval_min
+                )
+            returning
+                route_id,
+                serial_no,
+                it_is_return,
+                stop_id,
+                interval_min
+        '''.format(columns=', '.join(_PHI_COLUMNS)))
+        phi_rows = cur.fetchall()
+
+        metrics.inc('mrbus_rows_total', len(phi_rows), table='phi', op='merge')
+
+        # the stops past the new length of a shortened route
+        cur.execute('''
+            delete from
                 phi
+            using (
+                select
+                    route_id,
+                    max(serial_no)+1 as phi_n
+                from
+                    phi_stage
+                group by
+                    route_id
+            ) as staged
             where
-                (route_id, serial_no) in %s
-            for update
-        ''', (tuple(pks), ))
-        existent_pk_set = set(cur)
+                phi.route_id = staged.route_id and
+                phi.serial_no >= staged.phi_n
+            returning
+                phi.route_id,
+                phi.serial_no,
+                phi.stop_id
+        ''')
+        removed_phi_rows = cur.fetchall()
+
+        metrics.inc(
+            'mrbus_rows_total', len(removed_phi_rows),
+            table = 'phi',
+            op = 'delete'
+        )
 
-        now_dt = get_now_dt()
-        to_update_pds = []
-        to_insert_pds = []
-        for pk in pks:
-            if pk in existent_pk_set:
-                pd = pk_pd_map[pk]
-                pd['updated_ts'] = now_dt
-                to_update_pds.append(pd)
-            else:
-                pd = pk_pd_map[pk]
-                pd['updated_ts'] = now_dt
-                pd['created_ts'] = now_dt
-                to_insert_pds.append(pd)
+        cur.execute('''
+            update
+                route
+            set
+                topology_ts = %s
+            where
+                id in %s
+            returning
+                id,
+                name
+        ''', (now_dt, tuple(set(phi.route_id for phi in phis))))
+        route_rows = cur.fetchall()
+
+    # for patching the phi index
+    return (route_rows, phi_rows, removed_phi_rows)
+
+# the eta history
+#
+# every snapshot merged into phi is also appended into eta_history, which is
+# partitioned by day; the recent ones are also kept in _eta_ring_buffer.
+
+_ETA_HISTORY_COLUMNS = (
+    'route_id',
+    'serial_no',
+    'status_code',
+    'waiting_min',
+    'ts'
+)
+# the attrs of the records as the above columns
+_ETA_HISTORY_ATTRS = _ETA_HISTORY_COLUMNS[:-1]+('updated_ts', )
+
+_eta_ring_buffer = EtaRingBuffer()
+# the days whose partition is known to exist
+_eta_history_day_set = set()
+
+# duplicate_table, and unique_violation on pg_type; `if not exists` doesn't
+# stop two processes creating the same partition at once
+_PARTITION_EXISTS_PGCODES = ('42P07', '23505')
+
+def _create_eta_history_partition(day):
+
+    # the bounds must be literals
+    try:
+        with db as cur:
+            cur.execute('''
+                create table if not exists
+                    eta_history_{day:%Y%m%d}
+                partition of
+                    eta_history
+                for values from
+                    ('{day:%Y-%m-%d}') to ('{next_day:%Y-%m-%d}')
+            '''.format(day=day, next_day=day+timedelta(days=1)))
+    except Exception as e:
+        if getattr(e, 'pgcode', None) not in _PARTITION_EXISTS_PGCODES:
+            raise
+        debug('eta_history_{:%Y%m%d} is created by another'.format(day))
 
-        debug('len(to_update_pds) = {!r}'.format(len(to_update_pds)))
-        debug('len(to_insert_pds) = {!r}'.format(len(to_insert_pds)))
+    _eta_history_day_set.add(day)
 
-        if to_update_pds:
-            cur.executemany('''
-                update
-                    phi
-                set
-                    it_is_return = %(it_is_return)s,
-                    stop_id      = %(stop_id)s,
-                    status_code  = %(status_code)s,
-                    waiting_min  = %(waiting_min)s,
-                    interval_min = coalesce(
-                        (interval_min+%(interval_min)s)/2,
-                        %(interval_min)s,
-                        interval_min
-                    ),
-                    updated_ts   = %(updated_ts)s
-                where
-                    (route_id, serial_no) = (%(route_id)s, %(serial_no)s)
-            ''', to_update_pds)
+def _append_eta_history(rs):
 
-        if to_insert_pds:
-            cur.executemany('''
-                insert into
-                    phi (
-                        route_id,
-                        serial_no,
-                        it_is_return,
-                        stop_id,
-                        status_code,
-                        waiting_min,
-                        interval_min,
-                        updated_ts,
-                        created_ts
-                    )
-                values (
-                    %(route_id)s,
-                    %(serial_no)s,
-                    %(it_is_return)s,
-                    %(stop_id)s,
-                    %(status_code)s,
-                    %(waiting_min)s,
-                    %(interval_min)s,
-                    %(updated_ts)s,
-                    %(created_ts)s
-                )
-            ''', to_insert_pds)
+    # rs: the phis or etas records just merged
+
+    if not rs:
+        return
+
+    for day in set(r.updated_ts.date() for r in rs):
+        if day not in _eta_history_day_set:
+            _create_eta_history_partition(day)
+
+    with db as cur:
+        copy_rows(cur, 'eta_history', _ETA_HISTORY_COLUMNS, (
+            r.to_row(_ETA_HISTORY_ATTRS) for r in rs
+        ))
+
+    metrics.inc('mrbus_rows_total', len(rs), table='eta_history', op='copy')
+
+    rid_pairs_map = {}
+    for r in rs:
+        rid_pairs_map.setdefault(r.route_id, []).append((
+            r.serial_no,
+            encode_eta(r.status_code, r.waiting_min)
+        ))
+
+    now_ts = time()
+    for rid, sno_val_pairs in rid_pairs_map.iteritems():
+        _eta_ring_buffer.append(rid, now_ts, sno_val_pairs)
+
+def query_recent_etas(route_id, serial_no):
+    # -> [(ts, status_code, waiting_min), ...] from the oldest, of this
+    #    process's syncs
+    return _eta_ring_buffer.get(route_id, serial_no)
+
+def _is_fetched(route_page_pair):
+    # a failed fetching has no hash; a sec not existing is 'Not found'
+    return all(
+        rpage.page_hash is not None and rpage.api_hash is not None
+        for rpage in route_page_pair
+    )
+
+def _is_complete(route_page_pair):
+
+    # both of the pages and apis are fetched, and every stop on the page has
+    # its eta
+    #
+    # a failed page has no stop, and the serial_nos of the other sec would
+    # start from 0, which overwrites the phis, so it must be fetched
+
+    return _is_fetched(route_page_pair) and all(
+        set(rpage.get_idx_name_map()) <= set(rpage.get_idx_eta_map())
+        for rpage in route_page_pair
+    )
+
+def _touch_topology(route_ids):
+
+    if not route_ids:
+        return
+
+    with db as cur:
+        cur.execute('''
+            update
+                route
+            set
+                topology_ts = %s
+            where
+                id = any(%s)
+        ''', (get_now_dt(), list(route_ids)))
+
+def _sync_stops_n_phis_on_route_page_pairs(rid_rpagep_map):
+
+    # returns the ids of the routes synced, including the unchanged ones
+
+    changed_rid_rpagep_map = {
+        rid: rpagep
+        for rid, rpagep in rid_rpagep_map.iteritems()
+        if not _is_unchanged(rpagep)
+    }
+    unchanged_rids = [
+        rid for rid in rid_rpagep_map if rid not in changed_rid_rpagep_map
+    ]
+    metrics.inc('mrbus_routes_total', len(unchanged_rids), sync='unchanged')
+
+    # the topology of them is verified, so they aren't stale for the eta syncs
+    _touch_topology(unchanged_rids)
+
+    rid_rpagep_map = {
+        rid: rpagep
+        for rid, rpagep in changed_rid_rpagep_map.iteritems()
+        if _is_complete(rpagep)
+    }
+
+    # merge stops first
+
+    sname_set = set()
+    for rpagep in rid_rpagep_map.itervalues():
+        for rpage in rpagep:
+            sname_set.update(rpage.get_idx_name_map().itervalues())
+
+    if not sname_set:
+        # all of the pages are failed to fetch, keep the stored ones
+        debug('no stop on {!r}'.format(rid_rpagep_map.keys()))
+        return unchanged_rids
+
+    with metrics.timed('mrbus_phase_seconds', phase='stop_merge'):
+        sname_sid_map = _sid_cache.get_sid_map(sname_set)
+
+    # then merge phi
+
+    phis = []
+    raw_etas = []
+    for rid, rpagep in rid_rpagep_map.iteritems():
+        route_phis, route_raw_etas = _build_phis(rid, rpagep, sname_sid_map)
+        phis.extend(route_phis)
+        raw_etas.extend(route_raw_etas)
+
+    # in one transaction, so the blends of the concurrent syncs are in turn
+    with db:
+
+        with metrics.timed('mrbus_phase_seconds', phase='interval'):
+            _fill_eta_columns(
+                phis,
+                raw_etas,
+                _query_interval_mins(list(rid_rpagep_map))
+            )
+
+        with metrics.timed('mrbus_phase_seconds', phase='phi_merge'):
+            route_rows, phi_rows, removed_phi_rows = _merge_phis(phis)
+
+    # after merging, or a failed merge would be skipped next time
+    _update_route_hashes(rid_rpagep_map, 'page_hashes')
+    _update_route_hashes(rid_rpagep_map, 'api_hashes')
+
+    with metrics.timed('mrbus_phase_seconds', phase='history'):
+        _append_eta_history(phis)
+
+    if _phi_index.is_loaded():
+        _phi_index.patch(
+            route_rows,
+            phi_rows,
+            ((sid, sname) for sname, sid in sname_sid_map.iteritems()),
+            removed_phi_rows
+        )
+
+    # after patching, so the results cached again are from the new phis
+    _invalidate_plans_by_routes(
+        set(row[0] for row in phi_rows+removed_phi_rows),
+        set(row[3] for row in phi_rows) | set(
+            row[2] for row in removed_phi_rows
+        )
+    )
+    _invalidate_transfer_plans()
+
+    return unchanged_rids+list(rid_rpagep_map)
+
+def _fetch_route_page_pairs(pool, rids, end_ts=None):
+
+    rid_hashes_map = _query_route_hashes(rids)
+
+    # rpagep: route page pair
+    rid_rpagep_map = {}
+    futures = []
+
+    for rid in rids:
 
-def sync_stops_n_phis_of_all_routes():
+        rpagep = _create_route_page_pair(
+            rid,
+            end_ts,
+            rid_hashes_map.get(rid)
+        )
+        rid_rpagep_map[rid] = rpagep
+
+        # fetch pages asyncly; the unchanged ones are not parsed
+        for rpage in rpagep:
+            futures.append(pool.apply_async(rpage.load_page))
+            futures.append(pool.apply_async(rpage.load_api))
+
+    return (rid_rpagep_map, futures)
+
+def _wait_n_sync_route_page_pairs(rid_rpagep_map, futures):
+
+    # returns the seconds waited for networking
 
     start_ts = time()
-    networking_sec = 0
+    wait(futures)
+    networking_sec = time()-start_ts
 
-    for rids in _query_route_ids_it():
+    # merge these routes' stops and phis at once
+    _sync_stops_n_phis_on_route_page_pairs(rid_rpagep_map)
 
-        networing_start_ts = time()
+    return networking_sec
 
-        # rpagep: route page pair
-        rid_rpagep_map = {}
+def sync_stops_n_phis_of_all_routes(
+    pool=None, chunk_size=100, use_named_cursor=False, budget_sec=None
+):
 
-        for rid in rids:
+    # pool: mrbus.pool.Pool by default, or mrbus.green.Engine for a sweep
+    #       bounded by the upstream instead of the thread count
+    # use_named_cursor: stream the route ids from a snapshot instead of
+    #                   paging them
+    # budget_sec: the deadline of this sweep; no request is sent after it,
+    #             and the routes not fetched in time wait for the next sweep
 
-            rpagep = _create_route_page_pair(rid)
-            rid_rpagep_map[rid] = rpagep
+    if pool is None:
+        pool = _get_pool()
 
-            # fetch pages asyncly
-            for rpage in rpagep:
-                _pool.apply_async(rpage.get_idx_name_map)
-                _pool.apply_async(rpage.get_idx_eta_map)
+    start_ts = time()
+    end_ts = _get_end_ts(start_ts, budget_sec)
+    networking_sec = 0
 
-        # wait for fetching pages
-        _pool.join()
+    # fetch the next chunk while merging the last one
+    last_fetching = None
 
-        networking_sec += time()-networing_start_ts
+    for rids in _query_route_ids_it(chunk_size, use_named_cursor):
 
-        # merge this route's stops
-        for rid in rids:
-            _sync_stops_n_phis_on_route_page_pair(rid, rid_rpagep_map[rid])
+        if end_ts is not None and time() >= end_ts:
+            debug('out of the budget {}s'.format(budget_sec))
+            break
 
-    debug('Took {:.3f}s on networking.'.format(networking_sec))
-    debug('Took {:.3f}s.'.format(time()-start_ts))
+        fetching = _fetch_route_page_pairs(pool, rids, end_ts)
+
+        if last_fetching is not None:
+            networking_sec += _wait_n_sync_route_page_pairs(*last_fetching)
+
+        last_fetching = fetching
+
+    if last_fetching is not None:
+        networking_sec += _wait_n_sync_route_page_pairs(*last_fetching)
+
+    _observe_sweep('stops_n_phis', start_ts, networking_sec)
     # debug: sync_stops_n_phis_of_all_routes: Took 75.461s on networking.
     # debug: sync_stops_n_phis_of_all_routes: Took 92.833s.
 
+def sync_stops_n_phis_of_routes(route_ids, pool=None, budget_sec=None):
+
+    # the stops and phis of the given routes only, e.g., for mrbus.lease
+    # returns the ids of the routes synced; the others are failed to fetch
+
+    if pool is None:
+        pool = _get_pool()
+
+    if not route_ids:
+        return []
+
+    rid_rpagep_map, futures = _fetch_route_page_pairs(
+        pool,
+        route_ids,
+        _get_end_ts(time(), budget_sec)
+    )
+    wait(futures)
+
+    return _sync_stops_n_phis_on_route_page_pairs(rid_rpagep_map)
+
 def sync_stops_n_phis_of_route(route_id):
 
     start_ts = time()
 
-    rpagep = _create_route_page_pair(route_id)
+    rid_rpagep_map, futures = _fetch_route_page_pairs(_get_pool(), [route_id])
+    networking_sec = _wait_n_sync_route_page_pairs(rid_rpagep_map, futures)
+
+    debug('Took {:.3f}s on networking.'.format(networking_sec))
 
-    # fetch pages asyncly
-    for rpage in rpagep:
-        _pool.apply_async(rpage.get_idx_name_map)
-        _pool.apply_async(rpage.get_idx_eta_map)
+    debug('Took {:.3f}s.'.format(time()-start_ts))
 
-    # wait for fetching pages
-    _pool.join()
+def _query_interval_mins(route_ids):
 
-    debug('Took {:.3f}s on networking.'.format(time()-start_ts))
+    # -> {(route_id, serial_no): interval_min}
+    #
+    # the rows are locked until the transaction ends, so call it in the one of
+    # the merge, or a concurrent sync's blend is lost; in the order of the
+    # keys, so the syncs don't deadlock
 
-    _sync_stops_n_phis_on_route_page_pair(route_id, rpagep)
+    if not route_ids:
+        return {}
 
-    debug('Took {:.3f}s.'.format(time()-start_ts))
+    with db as cur:
+        cur.execute('''
+            select
+                route_id,
+                serial_no,
+                interval_min
+            from
+                phi
+            where
+                route_id in %s
+            order by
+                route_id,
+                serial_no
+            for update
+        ''', (tuple(route_ids), ))
+        return {
+            (route_id, serial_no): interval_min
+            for route_id, serial_no, interval_min in cur
+        }
 
-def query_stops(keyword):
+def _query_route_layouts(route_ids, topology_min_dt):
+
+    # layout: the stored phis of a route page pair,
+    #         ({idx: serial_no} of departure, {idx: serial_no} of return)
+    #
+    # only the routes whose topology is synced after topology_min_dt are
+    # returned; the others need the full sync.
+    #
+    # returns {route_id: layout}
+
+    if not route_ids:
+        return {}
 
     with db as cur:
 
+        cur.execute('''
+            select
+                route_id,
+                it_is_return,
+                idx,
+                serial_no
+            from
+                phi
+            join
+                route
+            on
+                route.id = route_id
+            where
+                route_id in %s and
+                topology_ts >= %s
+        ''', (tuple(route_ids), topology_min_dt))
+
+        rid_layout_map = {}
+        for route_id, it_is_return, idx, serial_no in cur:
+            layout = rid_layout_map.get(route_id)
+            if layout is None:
+                layout = rid_layout_map[route_id] = ({}, {})
+            layout[it_is_return][idx] = serial_no
+
+        return rid_layout_map
+
+def _layout_matches(layout, route_page_pair):
+    return all(
+        set(rpage.get_idx_eta_map()) == set(idx_sno_map)
+        for idx_sno_map, rpage in zip(layout, route_page_pair)
+    )
+
+def _build_etas(route_id, layout, route_page_pair):
+
+    # sno: serial_no
+    sno_eta_pairs = []
+    for idx_sno_map, rpage in zip(layout, route_page_pair):
+        idx_eta_map = rpage.get_idx_eta_map()
+        for idx, sno in idx_sno_map.iteritems():
+            sno_eta_pairs.append((sno, idx_eta_map[idx]))
+
+    sno_eta_pairs.sort()
+
+    now_dt = get_now_dt()
+    etas = [
+        Eta(route_id, sno, updated_ts=now_dt)
+        for sno, _ in sno_eta_pairs
+    ]
+
+    # the raw etas are for _fill_eta_columns
+    return (etas, [eta for _, eta in sno_eta_pairs])
+
+_ETA_COLUMNS = Eta.__slots__
+
+def _merge_phi_etas(etas):
+
+    with db as cur:
+
+        cur.execute('''
+            create temp table
+                phi_eta_stage (like phi)
+            on commit drop
+        ''')
+
+        copy_rows(cur, 'phi_eta_stage', _ETA_COLUMNS, (
+            eta.to_row() for eta in etas
+        ))
+
+        cur.execute('''
+            update
+                phi
+            set
+                status_code  = stage.status_code,
+                waiting_min  = stage.waiting_min,
+                interval_min = stage.interval_min,
+                updated_ts   = stage.updated_ts
+            from
+                phi_eta_stage as stage
+            where
+                (phi.route_id, phi.serial_no) =
+                (stage.route_id, stage.serial_no) and
+                (phi.status_code, phi.waiting_min, phi.interval_min)
+                is distinct from
+                (stage.status_code, stage.waiting_min, stage.interval_min)
+            returning
+                phi.route_id,
+                phi.serial_no,
+                phi.interval_min
+        ''')
+        rows = cur.fetchall()
+
+        metrics.inc(
+            'mrbus_rows_total', len(rows),
+            table='phi', op='merge_etas'
+        )
+
+    # for patching the phi index
+    return rows
+
+def _summarize_etas(route_page_pair):
+
+    # -> (it_is_running, {(it_is_return, idx): waiting_min}), or None if the
+    #    api is failed to fetch
+
+    idx_eta_maps = [rpage.get_idx_eta_map() for rpage in route_page_pair]
+    if not any(idx_eta_maps):
+        return None
+
+    it_is_running = False
+    key_wmin_map = {}
+    for it_is_return, idx_eta_map in enumerate(idx_eta_maps):
+        for idx, eta in idx_eta_map.iteritems():
+            if eta in _ETA_NZSCODE_MAP:
+                continue
+            it_is_running = True
+            key_wmin_map[(bool(it_is_return), idx)] = eta
+
+    return (it_is_running, key_wmin_map)
+
+def _sync_etas_of_route_ids(pool, rids, topology_min_dt, end_ts=None):
+
+    # returns ({rid: the summary of the etas}, the seconds on networking)
+
+    networking_start_ts = time()
+
+    rid_layout_map = _query_route_layouts(rids, topology_min_dt)
+    rid_hashes_map = _query_route_hashes(rids)
+
+    # rpagep: route page pair
+    rid_rpagep_map = {}
+    futures = []
+
+    for rid in rids:
+
+        rpagep = _create_route_page_pair(
+            rid,
+            end_ts,
+            rid_hashes_map.get(rid)
+        )
+        rid_rpagep_map[rid] = rpagep
+
+        for rpage in rpagep:
+            if rid not in rid_layout_map:
+                futures.append(pool.apply_async(rpage.load_page))
+            futures.append(pool.apply_async(rpage.load_api))
+
+    wait(futures)
+
+    to_sync_topology_rids = [
+        rid for rid in rids if rid not in rid_layout_map
+    ]
+
+    unchanged_rid_set = set()
+    eta_rid_rpagep_map = {}
+    etas = []
+    raw_etas = []
+    futures = []
+    for rid, layout in rid_layout_map.iteritems():
+
+        rpagep = rid_rpagep_map[rid]
+
+        if _is_unchanged(rpagep, with_page=False):
+            unchanged_rid_set.add(rid)
+            continue
+
+        if any(
+            idx_sno_map and not rpage.get_idx_eta_map()
+            for idx_sno_map, rpage in zip(layout, rpagep)
+        ):
+            # the api is failed to fetch, try it next time
+            continue
+
+        if not _layout_matches(layout, rpagep):
+            to_sync_topology_rids.append(rid)
+            for rpage in rpagep:
+                futures.append(pool.apply_async(rpage.get_idx_name_map))
+            continue
+
+        route_etas, route_raw_etas = _build_etas(rid, layout, rpagep)
+        etas.extend(route_etas)
+        raw_etas.extend(route_raw_etas)
+        eta_rid_rpagep_map[rid] = rpagep
+
+    wait(futures)
+
+    networking_sec = time()-networking_start_ts
+
+    metrics.inc(
+        'mrbus_routes_total', len(to_sync_topology_rids),
+        sync='topology'
+    )
+    metrics.inc(
+        'mrbus_routes_total', len(unchanged_rid_set),
+        sync='unchanged'
+    )
+
+    if etas:
+        # in one transaction, so the blends of the concurrent syncs are in
+        # turn
+        with db:
+            with metrics.timed('mrbus_phase_seconds', phase='interval'):
+                _fill_eta_columns(
+                    etas,
+                    raw_etas,
+                    _query_interval_mins(list(eta_rid_rpagep_map))
+                )
+            with metrics.timed('mrbus_phase_seconds', phase='phi_merge'):
+                rows = _merge_phi_etas(etas)
+        _update_route_hashes(eta_rid_rpagep_map, 'api_hashes')
+        with metrics.timed('mrbus_phase_seconds', phase='history'):
+            _append_eta_history(etas)
+        if _phi_index.is_loaded():
+            _phi_index.update_interval_mins(rows)
+        # the direct plans don't depend on the etas
+        _invalidate_transfer_plans()
+
+    # the ones skipped as incomplete are not returned
+    topology_synced_rids = []
+    if to_sync_topology_rids:
+        topology_synced_rids = _sync_stops_n_phis_on_route_page_pairs({
+            rid: rid_rpagep_map[rid] for rid in to_sync_topology_rids
+        })
+
+    # only the routes written, or unchanged, with None for the unchanged
+    rid_summary_map = dict.fromkeys(unchanged_rid_set)
+    for rid in chain(eta_rid_rpagep_map, topology_synced_rids):
+        if rid not in unchanged_rid_set:
+            rid_summary_map[rid] = _summarize_etas(rid_rpagep_map[rid])
+
+    return (rid_summary_map, networking_sec)
+
+def sync_etas_of_all_routes(
+    pool=None, chunk_size=100, topology_ttl=timedelta(days=1),
+    use_named_cursor=False, budget_sec=None
+):
+
+    # it only fetches the small RouteInfo api and writes the etas into the
+    # stored layout; the route map page is fetched only when the topology is
+    # older than topology_ttl or the api doesn't match the stored layout.
+
+    if pool is None:
+        pool = _get_pool()
+
+    start_ts = time()
+    end_ts = _get_end_ts(start_ts, budget_sec)
+    networking_sec = 0
+
+    for rids in _query_route_ids_it(chunk_size, use_named_cursor):
+
+        if end_ts is not None and time() >= end_ts:
+            debug('out of the budget {}s'.format(budget_sec))
+            break
+
+        _, chunk_networking_sec = _sync_etas_of_route_ids(
+            pool,
+            rids,
+            get_now_dt()-topology_ttl,
+            end_ts
+        )
+        networking_sec += chunk_networking_sec
+
+    _observe_sweep('etas', start_ts, networking_sec)
+
+def sync_etas_of_routes(
+    route_ids, pool=None, topology_ttl=timedelta(days=1), budget_sec=None
+):
+
+    # the etas of the given routes only, e.g., for mrbus.sched
+    # returns {route_id: (it_is_running, {(it_is_return, idx): waiting_min})}
+    # of the routes fetched, and None for the unchanged since last time
+
+    if pool is None:
+        pool = _get_pool()
+
+    if not route_ids:
+        return {}
+
+    rid_summary_map, _ = _sync_etas_of_route_ids(
+        pool,
+        route_ids,
+        get_now_dt()-topology_ttl,
+        _get_end_ts(time(), budget_sec)
+    )
+
+    return rid_summary_map
+
+# the in-process indexes for the queries; they are loaded at the first query,
+# then patched by the syncs in this process, and reloaded after the ttl for
+# the syncs in the others
+_INDEX_TTL_SEC = 600
+
+def _get_loaded_index(index, load, lock):
+
+    if not index.is_loaded():
+        with lock:
+            if not index.is_loaded():
+                load()
+
+    elif time()-index.loaded_ts > _INDEX_TTL_SEC:
+        # the others keep querying the current one while reloading
+        if lock.acquire(False):
+            try:
+                load()
+            finally:
+                lock.release()
+
+    return index
+
+_stop_name_index = StopNameIndex()
+_stop_name_index_lock = Lock()
+
+def _load_stop_name_index():
+
+    with db as cur:
+        cur.execute('select id, name from stop')
+        _stop_name_index.load(cur.fetchall())
+
+    debug('loaded {!r}'.format(_stop_name_index.get_stats()))
+
+def _query_stops(keyword, limit, use_index):
+
+    if use_index:
+        with metrics.timed('mrbus_query_seconds', query='stops'):
+            return _get_loaded_index(
+                _stop_name_index,
+                _load_stop_name_index,
+                _stop_name_index_lock
+            ).search(keyword, limit)
+
+    with db as cur:
+
+        # it uses the trigram index of stop (name)
         cur.execute('''
             select
                 id,
@@ -464,12 +1434,52 @@ def query_stops(keyword):
             where
                 name like %s
             order by
-                char_length(name)
-        ''', (u'%{}%'.format(escape_like_operand(keyword)), ))
+                strpos(name, %s) <> 1,
+                char_length(name),
+                name
+            limit
+                %s
+        ''', (u'%{}%'.format(escape_like_operand(keyword)), keyword, limit))
 
         return all_to_dicts(cur)
 
-def query_plans(orig_stop_ids, dest_stop_ids):
+_phi_index = PhiIndex()
+_phi_index_lock = Lock()
+
+def _load_phi_index():
+
+    with db as cur:
+
+        cur.execute('select id, name from route')
+        route_rows = cur.fetchall()
+
+        cur.execute('select id, name from stop')
+        stop_rows = cur.fetchall()
+
+        cur.execute('''
+            select
+                route_id,
+                serial_no,
+                it_is_return,
+                stop_id,
+                interval_min
+            from
+                phi
+        ''')
+        phi_rows = cur.fetchall()
+
+    _phi_index.load(route_rows, stop_rows, phi_rows)
+
+    debug('loaded {!r}'.format(_phi_index.get_stats()))
+
+def _get_phi_index():
+    return _get_loaded_index(_phi_index, _load_phi_index, _phi_index_lock)
+
+def _query_plans(orig_stop_ids, dest_stop_ids, use_index):
+
+    if use_index:
+        with metrics.timed('mrbus_query_seconds', query='plans'):
+            return _get_phi_index().find_direct(orig_stop_ids, dest_stop_ids)
 
     with db as cur:
 
@@ -545,6 +1555,214 @@ def query_plans(orig_stop_ids, dest_stop_ids):
 
         return all_to_dicts(cur)
 
+# the results of the queries
+#
+# the syncs in this process invalidate the affected entries by the tags:
+#
+# 1. stops: ('gram', the first gram of the keyword), by the new stop names.
+# 2. plans: ('stop', stop_id) of the args, by the stops on the changed routes;
+#    ('route', route_id) of the results, by the changed routes.
+# 3. transfer plans: ('phi', ), by any change of the phis, as they depend on
+#    the intervals.
+#
+# and the ttl covers the syncs in the others.
+_QUERY_CACHE_TTL_SEC = 60
+_query_cache_map = {
+    'stops'         : LRUCache(10000, ttl=_QUERY_CACHE_TTL_SEC),
+    'plans'         : LRUCache(10000, ttl=_QUERY_CACHE_TTL_SEC),
+    'transfer_plans': LRUCache(1000, ttl=_QUERY_CACHE_TTL_SEC)
+}
+
+_QUERY_CACHE_STAT_NAMES = (
+    'size', 'hit_n', 'miss_n', 'eviction_n', 'invalidation_n'
+)
+
+def _register_query_cache_gauges():
+    for name, cache in _query_cache_map.iteritems():
+        for stat_name in _QUERY_CACHE_STAT_NAMES:
+            metrics.register_gauge(
+                'mrbus_query_cache_{}'.format(stat_name),
+                lambda c=cache, k=stat_name: c.get_stats()[k],
+                cache = name
+            )
+
+_register_query_cache_gauges()
+
+def _copy_ds(ds):
+    # the cached results are shared, so each caller gets its own copy
+    return deepcopy(ds)
+
+def get_query_cache_stats():
+    return {
+        name: cache.get_stats()
+        for name, cache in _query_cache_map.iteritems()
+    }
+
+# route_id -> the times shown in the plans, the demand for mrbus.sched
+#
+# the queries and the scheduler are usually in different processes, so the
+# counts are buffered here, and flushed into the route_demand table every
+# _DEMAND_FLUSH_SEC by the queries; pop_route_demands drains both.
+_DEMAND_FLUSH_SEC = 5
+_rid_demand_n_map = {}
+_rid_demand_n_map_lock = Lock()
+_demand_flushed_ts = time()
+
+def _add_route_demands(route_ids):
+
+    global _demand_flushed_ts
+
+    with _rid_demand_n_map_lock:
+
+        for rid in route_ids:
+            _rid_demand_n_map[rid] = _rid_demand_n_map.get(rid, 0)+1
+
+        now_ts = time()
+        if now_ts-_demand_flushed_ts < _DEMAND_FLUSH_SEC:
+            return
+        _demand_flushed_ts = now_ts
+
+        rid_demand_n_map = dict(_rid_demand_n_map)
+        _rid_demand_n_map.clear()
+
+    _flush_route_demands(rid_demand_n_map)
+
+def _flush_route_demands(rid_demand_n_map):
+
+    if not rid_demand_n_map:
+        return
+
+    rids, demand_ns = zip(*rid_demand_n_map.iteritems())
+
+    # the demands are only hints, so a failure mustn't fail the query
+    try:
+        with db as cur:
+            cur.execute('''
+                insert into
+                    route_demand (route_id, demand_n)
+                select
+                    unnest(%s::text[]),
+                    unnest(%s::int[])
+                on conflict
+                    (route_id)
+                do update set
+                    demand_n = route_demand.demand_n+excluded.demand_n
+            ''', (list(rids), list(demand_ns)))
+    except Exception as e:
+        debug('{}: {}'.format(e.__class__.__name__, e))
+
+def pop_route_demands():
+
+    # -> {route_id: demand_n} of this process and the flushed ones
+
+    with _rid_demand_n_map_lock:
+        rid_demand_n_map = dict(_rid_demand_n_map)
+        _rid_demand_n_map.clear()
+
+    with db as cur:
+        cur.execute('''
+            delete from
+                route_demand
+            returning
+                route_id,
+                demand_n
+        ''')
+        for rid, demand_n in cur:
+            rid_demand_n_map[rid] = rid_demand_n_map.get(rid, 0)+demand_n
+
+    return rid_demand_n_map
+
+def _normalize_stop_ids(stop_ids):
+    return frozenset(int(sid) for sid in stop_ids)
+
+def _get_keyword_tag(keyword):
+    # a name contains the keyword only if it has the keyword's first gram
+    return ('gram', keyword[:2])
+
+def _invalidate_stops_by_names(snames):
+    tags = set()
+    for sname in snames:
+        tags.update(('gram', gram) for gram in iter_grams(sname))
+    # the empty keyword
+    tags.add(('gram', u''))
+    _query_cache_map['stops'].invalidate(tags)
+
+def _invalidate_plans_by_routes(route_ids, stop_ids=()):
+    tags = [('route', rid) for rid in route_ids]
+    tags.extend(('stop', sid) for sid in stop_ids)
+    _query_cache_map['plans'].invalidate(tags)
+
+def _invalidate_transfer_plans():
+    _query_cache_map['transfer_plans'].invalidate([('phi', )])
+
+def query_stops(keyword, limit=None, use_index=True):
+
+    # the prefix matches first, then the shorter
+
+    keyword = ensure_unicode(keyword).strip()
+
+    cache = _query_cache_map['stops']
+    key = (keyword, limit, use_index)
+
+    stop_ds = cache.get(key)
+    if stop_ds is None:
+        stop_ds = _query_stops(keyword, limit, use_index)
+        cache.put(key, stop_ds, [_get_keyword_tag(keyword)])
+
+    return _copy_ds(stop_ds)
+
+def query_plans(orig_stop_ids, dest_stop_ids, use_index=True):
+
+    orig_stop_ids = _normalize_stop_ids(orig_stop_ids)
+    dest_stop_ids = _normalize_stop_ids(dest_stop_ids)
+
+    cache = _query_cache_map['plans']
+    key = (orig_stop_ids, dest_stop_ids, use_index)
+
+    plan_ds = cache.get(key)
+    if plan_ds is None:
+        plan_ds = _query_plans(orig_stop_ids, dest_stop_ids, use_index)
+        tags = [('stop', sid) for sid in orig_stop_ids | dest_stop_ids]
+        tags.extend(('route', d['route_id']) for d in plan_ds)
+        cache.put(key, plan_ds, tags)
+
+    _add_route_demands(d['route_id'] for d in plan_ds)
+
+    return _copy_ds(plan_ds)
+
+def query_transfer_plans(
+    orig_stop_ids, dest_stop_ids, max_transfer_n=1, limit=10
+):
+
+    # the plans which need transfers, ranked by the summed driving_min; see
+    # PhiIndex.find_plans. max_transfer_n=2 costs more, use it only when no
+    # direct or one-transfer plan is found.
+
+    orig_stop_ids = _normalize_stop_ids(orig_stop_ids)
+    dest_stop_ids = _normalize_stop_ids(dest_stop_ids)
+
+    cache = _query_cache_map['transfer_plans']
+    key = (orig_stop_ids, dest_stop_ids, max_transfer_n, limit)
+
+    plan_ds = cache.get(key)
+    if plan_ds is None:
+        with metrics.timed('mrbus_query_seconds', query='transfer_plans'):
+            plan_ds = _get_phi_index().find_plans(
+                orig_stop_ids,
+                dest_stop_ids,
+                max_transfer_n,
+                limit
+            )
+        cache.put(key, plan_ds, [('phi', )])
+
+    _add_route_demands(
+        leg_d['route_id']
+        for plan_d in plan_ds
+        for leg_d in plan_d['legs']
+    )
+
+    return _copy_ds(plan_ds)
+
 if __name__ == '__main__':
 
     import uniout
@@ -563,6 +1781,7 @@ if __name__ == '__main__':
         if s['name'] in (u'西門', u'捷運西門站')
     ]
     pprint(query_plans(orig_stop_ids, dest_stop_ids))
+    pprint(query_transfer_plans(orig_stop_ids, dest_stop_ids, limit=3))
 
     import sys; sys.exit()
 
@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from datetime import timedelta
 from mrbus.conn import db
+from mrbus.util import get_now_dt
 from mrbus.model import (
     sync_routes_on_all_route_indexes,
-    sync_stops_n_phis_of_all_routes
+    sync_stops_n_phis_of_all_routes,
+    sync_etas_of_all_routes,
+    _create_eta_history_partition,
+    _eta_history_day_set
 )
 
+# it needs PostgreSQL 11+, for the index on the partitioned eta_history
+
 def create_tables():
 
     # route
@@ -14,8 +21,11 @@ def create_tables():
     # 1. id -> tp_10723 / nt_114
     # 2. name
     # 3. on_index
-    # 4. updated_ts
-    # 5. created_ts
+    # 4. topology_ts -> when the stops on it are synced from the map page
+    # 5. page_hashes -> the md5 of the map pages of sec 0 and 1, last synced
+    # 6. api_hashes -> the md5 of the RouteInfo apis of sec 0 and 1
+    # 7. updated_ts
+    # 8. created_ts
     #
 
     # stop
@@ -33,12 +43,42 @@ def create_tables():
     # 1. route_id
     # 2. serial_no
     # 3. it_is_return
-    # 4. stop_id
-    # 5. status_code
-    # 6. waiting_min
-    # 7. interval_min
-    # 8. updated_ts
-    # 9. created_ts
+    # 4. idx -> the stop's idx on the route page
+    # 5. stop_id
+    # 6. status_code
+    # 7. waiting_min
+    # 8. interval_min
+    # 9. updated_ts
+    # 10. created_ts
+    #
+
+    # eta_history - the snapshots of the etas, append-only
+    #
+    # it's partitioned by the day of ts; the partitions are created by the
+    # syncs on demand, and dropped by drop_eta_history_before.
+    #
+    # 1. route_id
+    # 2. serial_no
+    # 3. status_code
+    # 4. waiting_min
+    # 5. ts
+    #
+
+    # route_lease - the work queue of the sharded sweeps, see mrbus.lease
+    #
+    # 1. sweep -> etas / stops_n_phis
+    # 2. route_id
+    # 3. due_ts -> when it shall be swept next
+    # 4. worker -> who leases it, or null
+    # 5. lease_ts -> when the lease expires; a crashed worker's is taken after
+    # 6. synced_ts
+    #
+
+    # route_demand - the times the routes are shown in the plans, flushed by
+    # the query processes and drained by mrbus.sched
+    #
+    # 1. route_id
+    # 2. demand_n
     #
 
     # serial  : 1 to 2147483647
@@ -52,16 +92,23 @@ def create_tables():
 
         cur.execute('''
             create table route (
-                id         text primary key,
-                name       text,
-                on_index   bool default true,
-                updated_ts timestamp,
-                created_ts timestamp
+                id          text primary key,
+                name        text,
+                on_index    bool default true,
+                topology_ts timestamp,
+                page_hashes text[],
+                api_hashes  text[],
+                updated_ts  timestamp,
+                created_ts  timestamp
             )
         ''')
 
         cur.execute('create index on route (name)')
         cur.execute('create index on route (on_index)')
+        # for the keyset pagination of the sweep
+        cur.execute('''
+            create index on route (created_ts, id) where on_index = true
+        ''')
 
         # stop
 
@@ -73,7 +120,15 @@ def create_tables():
             )
         ''')
 
-        cur.execute('create index on stop (name)')
+        cur.execute('create unique index on stop (name)')
+        # for the substring search of query_stops, name like '%keyword%'
+        cur.execute('create extension if not exists pg_trgm')
+        cur.execute('''
+            create index
+                stop_name_trgm_idx
+            on
+                stop using gin (name gin_trgm_ops)
+        ''')
 
         # phi
 
@@ -82,6 +137,7 @@ def create_tables():
                 route_id     text references route (id),
                 serial_no    smallint,
                 it_is_return bool,
+                idx          smallint,
                 stop_id      int references stop (id),
                 status_code  smallint,
                 waiting_min  smallint,
@@ -94,13 +150,274 @@ def create_tables():
 
         cur.execute('create index on phi (stop_id)')
 
+        # route_lease
+
+        cur.execute('''
+            create table route_lease (
+                sweep     text,
+                route_id  text references route (id),
+                due_ts    timestamp,
+                worker    text,
+                lease_ts  timestamp,
+                synced_ts timestamp,
+                primary key (sweep, route_id)
+            )
+        ''')
+
+        cur.execute('create index on route_lease (sweep, due_ts)')
+
+        # route_demand
+
+        cur.execute('''
+            create table route_demand (
+                route_id text primary key references route (id),
+                demand_n int
+            )
+        ''')
+
+        # eta_history
+
+        cur.execute('''
+            create table eta_history (
+                route_id    text,
+                serial_no   smallint,
+                status_code smallint,
+                waiting_min smallint,
+                ts          timestamp
+            ) partition by range (ts)
+        ''')
+
+        # the rows come in the order of ts, so a brin is enough and tiny
+        cur.execute('create index on eta_history using brin (ts)')
+
+    today = get_now_dt().date()
+    _create_eta_history_partition(today)
+    _create_eta_history_partition(today+timedelta(days=1))
+
+def _migrate_route_layout():
+
+    # the stored layout for the eta-only refresh
+
+    with db as cur:
+
+        cur.execute('''
+            alter table route
+                add column if not exists topology_ts timestamp
+        ''')
+
+        cur.execute('''
+            alter table phi
+                add column if not exists idx smallint
+        ''')
+
+def _migrate_stop_name_key():
+
+    # the stop names are unique for the upserts of the stop name cache; the
+    # duplicated ones are merged into the first one before
+
+    with db as cur:
+
+        cur.execute('''
+            select
+                1
+            from
+                pg_indexes
+            where
+                tablename = 'stop' and
+                indexdef like 'CREATE UNIQUE INDEX % (name)'
+        ''')
+        if cur.fetchone():
+            return
+
+        cur.execute('''
+            create temp table
+                stop_dup
+            on commit drop
+            as select
+                id,
+                min(id) over (partition by name) as first_id
+            from
+                stop
+        ''')
+        cur.execute('''
+            update
+                phi
+            set
+                stop_id = stop_dup.first_id
+            from
+                stop_dup
+            where
+                phi.stop_id = stop_dup.id and
+                stop_dup.id <> stop_dup.first_id
+        ''')
+        cur.execute('''
+            delete from
+                stop
+            using
+                stop_dup
+            where
+                stop.id = stop_dup.id and
+                stop_dup.id <> stop_dup.first_id
+        ''')
+
+        cur.execute('drop index if exists stop_name_idx')
+        cur.execute('create unique index stop_name_idx on stop (name)')
+
+def _migrate_route_keyset_index():
+
+    # for the keyset pagination of the sweep
+
+    with db as cur:
+        cur.execute('''
+            create index if not exists
+                route_created_ts_id_idx
+            on
+                route (created_ts, id)
+            where
+                on_index = true
+        ''')
+
+def _migrate_stop_name_trgm_index():
+
+    # for the substring search of query_stops
+
+    with db as cur:
+        cur.execute('create extension if not exists pg_trgm')
+        cur.execute('''
+            create index if not exists
+                stop_name_trgm_idx
+            on
+                stop using gin (name gin_trgm_ops)
+        ''')
+
+def _migrate_route_demand():
+
+    with db as cur:
+        cur.execute('''
+            create table if not exists route_demand (
+                route_id text primary key references route (id),
+                demand_n int
+            )
+        ''')
+
+def _migrate_eta_history():
+
+    with db as cur:
+
+        cur.execute('''
+            create table if not exists eta_history (
+                route_id    text,
+                serial_no   smallint,
+                status_code smallint,
+                waiting_min smallint,
+                ts          timestamp
+            ) partition by range (ts)
+        ''')
+
+        cur.execute('''
+            create index if not exists
+                eta_history_ts_idx
+            on
+                eta_history using brin (ts)
+        ''')
+
+    today = get_now_dt().date()
+    _create_eta_history_partition(today)
+    _create_eta_history_partition(today+timedelta(days=1))
+
+def _migrate_route_hashes():
+
+    # the content hashes of the last sync, to skip the unchanged routes
+
+    with db as cur:
+        cur.execute('''
+            alter table route
+                add column if not exists page_hashes text[],
+                add column if not exists api_hashes  text[]
+        ''')
+
+def _migrate_route_lease():
+
+    with db as cur:
+
+        cur.execute('''
+            create table if not exists route_lease (
+                sweep     text,
+                route_id  text references route (id),
+                due_ts    timestamp,
+                worker    text,
+                lease_ts  timestamp,
+                synced_ts timestamp,
+                primary key (sweep, route_id)
+            )
+        ''')
+
+        cur.execute('''
+            create index if not exists
+                route_lease_sweep_due_ts_idx
+            on
+                route_lease (sweep, due_ts)
+        ''')
+
+def migrate():
+
+    # bring the tables created by an older create_tables up to date, step by
+    # step in the order of the changes; each is idempotent, so just run it
+    # after each upgrade
+
+    _migrate_route_layout()
+    _migrate_stop_name_key()
+    _migrate_route_keyset_index()
+    _migrate_stop_name_trgm_index()
+    _migrate_route_demand()
+    _migrate_eta_history()
+    _migrate_route_hashes()
+    _migrate_route_lease()
+
+def drop_eta_history_before(days=30):
+
+    # drop the partitions older than the days
+
+    min_day_str = '{:%Y%m%d}'.format(get_now_dt().date()-timedelta(days=days))
+
+    with db as cur:
+
+        cur.execute('''
+            select
+                child.relname
+            from
+                pg_inherits
+            join
+                pg_class as parent
+            on
+                parent.oid = inhparent
+            join
+                pg_class as child
+            on
+                child.oid = inhrelid
+            where
+                parent.relname = 'eta_history'
+        ''')
+
+        for table_name, in cur.fetchall():
+            if table_name.rpartition('_')[2] < min_day_str:
+                cur.execute('drop table {}'.format(table_name))
+
+    # the dropped days are created again if any is synced
+    _eta_history_day_set.clear()
+
 def drop_tables():
 
     with db as cur:
+        cur.execute('drop table if exists eta_history')
+        cur.execute('drop table if exists route_lease')
+        cur.execute('drop table if exists route_demand')
         cur.execute('drop table phi')
         cur.execute('drop table stop')
         cur.execute('drop table route')
 
+    _eta_history_day_set.clear()
+
 if __name__ == '__main__':
 
     import clime
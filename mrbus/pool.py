@@ -3,103 +3,261 @@
 
 # a thread-based and simpler version of multiprocessing.Pool
 # ref: https://docs.python.org/2/library/multiprocessing.html#module-multiprocessing.pool
-
-from threading import Thread
-from Queue import Queue
+#
+# the future is a simpler version of concurrent.futures.Future
+# ref: https://docs.python.org/3/library/concurrent.futures.html#future-objects
+
+import sys
+from time import time
+from threading import Thread, Condition, Lock, current_thread
+from Queue import Queue, Empty, Full
 from mrbus.util import debug
+from mrbus.exc import TimeoutError
+
+class Future(object):
+
+    def __init__(self):
+        self._cond = Condition()
+        self._is_done = False
+        self._result = None
+        self._exc = None
+        # keeps the traceback of the worker
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._is_done
+
+    def _wait(self, timeout):
+
+        with self._cond:
+
+            if timeout is None:
+                while not self._is_done:
+                    self._cond.wait()
+                return
+
+            end_ts = time()+timeout
+            while not self._is_done:
+                remaining_sec = end_ts-time()
+                if remaining_sec <= 0:
+                    raise TimeoutError('not done in {}s'.format(timeout))
+                self._cond.wait(remaining_sec)
+
+    def result(self, timeout=None):
+        self._wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        if self._exc is not None:
+            raise self._exc
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exc
+
+    def add_done_callback(self, func):
+
+        with self._cond:
+            if not self._is_done:
+                self._callbacks.append(func)
+                return
+
+        func(self)
+
+    def _finish(self, result, exc, exc_info=None):
+
+        with self._cond:
+            self._result = result
+            self._exc = exc
+            self._exc_info = exc_info
+            self._is_done = True
+            self._cond.notify_all()
+            callbacks = self._callbacks
+            self._callbacks = []
+
+        for func in callbacks:
+            try:
+                func(self)
+            except BaseException as e:
+                debug('{}: {} from callback {}'.format(
+                    e.__class__.__name__,
+                    e,
+                    func
+                ))
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exc, exc_info=None):
+        # exc_info: sys.exc_info() of exc, to re-raise with its traceback
+        self._finish(None, exc, exc_info)
+
+def as_completed(futures, timeout=None):
+
+    # it yields the futures in the order they are done
+
+    futures = list(futures)
+
+    done_que = Queue()
+    for future in futures:
+        future.add_done_callback(done_que.put)
+
+    end_ts = None
+    if timeout is not None:
+        end_ts = time()+timeout
+
+    for _ in xrange(len(futures)):
+
+        remaining_sec = None
+        if end_ts is not None:
+            remaining_sec = max(end_ts-time(), 0)
+
+        try:
+            yield done_que.get(timeout=remaining_sec)
+        except Empty:
+            raise TimeoutError('not done in {}s'.format(timeout))
+
+def wait(futures, timeout=None):
+    for _ in as_completed(futures, timeout):
+        pass
+
+def _run_to_future(future, func, args, argd):
+
+    try:
+        retval = func(*(args or ()), **(argd or {}))
+    except BaseException as e:
+        debug('{}: {} from {} {} {}'.format(
+            e.__class__.__name__,
+            e,
+            func,
+            args,
+            argd
+        ))
+        future.set_exception(e, sys.exc_info())
+    else:
+        future.set_result(retval)
+
+def spawn(func, args=None, kwds=None):
+
+    # run it on a new daemon thread, for the few tasks which shouldn't queue
+    # behind the others
+
+    future = Future()
+
+    thread = Thread(target=_run_to_future, args=(future, func, args, kwds))
+    thread.daemon = True
+    thread.start()
+
+    return future
 
 class _Worker(Thread):
 
     daemon = True
 
-    def __init__(self, task_que, result_que):
+    def __init__(self, pool):
         Thread.__init__(self)
-        self._task_que = task_que
-        self._result_que = result_que
+        self._pool = pool
+        self._task_que = pool._task_que
 
     def run(self):
 
         while True:
 
-            no, func, args, argd = self._task_que.get()
+            task = self._task_que.get()
+
+            # None is the signal to retire, see Pool.resize
+            if task is None:
+                self._task_que.task_done()
+                break
 
+            self._pool._add_busy_n(1)
             try:
-                retval = func(*(args or ()), **(argd or {}))
-            except BaseException as e:
-                retval = e
-                debug('{}: {} from {} {} {}'.format(
-                    e.__class__.__name__,
-                    e,
-                    func,
-                    args,
-                    argd
-                ))
+                _run_to_future(*task)
+            finally:
+                self._pool._add_busy_n(-1)
 
+            # after setting the future, so join implies the futures are done
             self._task_que.task_done()
 
-            if no is not None:
-                self._result_que.put((no, retval))
-
 class Pool(object):
 
-    # NOTE: not thread-safe
+    # it is thread-safe; the callers can share a pool and wait on their own
+    # futures.
+    #
+    # maxsize: the capacity of the task queue, apply_async blocks the
+    #          producer when it is full; n*100 by default, and 0 for
+    #          unbounded. a task submitting to its own full pool runs inline
+    #          instead, or it would wait on itself.
 
-    def __init__(self, n=3):
+    def __init__(self, n=3, maxsize=None):
 
-        self._task_que = Queue()
-        self._result_que = Queue()
-        self._next_no = 0
+        if maxsize is None:
+            maxsize = n*100
 
-        for i in range(n):
-            worker = _Worker(self._task_que, self._result_que)
-            worker.start()
+        self._task_que = Queue(maxsize)
+        self._worker_n = 0
+        self._busy_n = 0
+        self._busy_n_lock = Lock()
+        self._lock = Lock()
 
-    def _get_next_no(self):
-        no = self._next_no
-        self._next_no += 1
-        return no
+        self.resize(n)
 
-    def join(self):
-        self._task_que.join()
+    def get_worker_n(self):
+        return self._worker_n
 
-    def apply_async(self, func, args=None, kwds=None):
+    def get_queue_size(self):
+        return self._task_que.qsize()
 
-        # here is no multiprocessing.pool.AsyncResult
-        self._task_que.put((
-            None,
-            func,
-            args,
-            kwds
-        ))
+    def _add_busy_n(self, n):
+        with self._busy_n_lock:
+            self._busy_n += n
 
-    def map(self, func, iterable):
+    def get_utilization(self):
+        # the ratio of the busy workers
+        if not self._worker_n:
+            return 0.
+        return float(self._busy_n)/self._worker_n
 
-        # XXX: it seems nobody uses it
+    def resize(self, n):
 
-        # dispatch tasks
+        with self._lock:
 
-        for item in iterable:
-            self._task_que.put((
-                self._get_next_no(),
-                func,
-                (item, ),
-                None
-            ))
+            while self._worker_n < n:
+                worker = _Worker(self)
+                worker.start()
+                self._worker_n += 1
 
-        self.join()
+            # the workers retire after the tasks queued before
+            while self._worker_n > n:
+                self._task_que.put(None)
+                self._worker_n -= 1
 
-        # collect the results
+    def join(self):
+        # it waits for all of the tasks, including other callers'
+        self._task_que.join()
 
-        no_result_pairs = []
-        while not self._result_que.empty():
-            no, retval = self._result_que.get_nowait()
-            if isinstance(retval, BaseException):
-                raise retval
-            no_result_pairs.append((no, retval))
+    def apply_async(self, func, args=None, kwds=None):
+
+        future = Future()
 
-        no_result_pairs.sort()
+        task = (future, func, args, kwds)
+
+        thread = current_thread()
+        if isinstance(thread, _Worker) and thread._pool is self:
+            try:
+                self._task_que.put_nowait(task)
+            except Full:
+                _run_to_future(future, func, args, kwds)
+            return future
 
-        return [result for _, result in no_result_pairs]
+        self._task_que.put(task)
+
+        return future
+
+    def map(self, func, iterable):
+        futures = [self.apply_async(func, (item, )) for item in iterable]
+        return [future.result() for future in futures]
 
 if __name__ == '__main__':
 
@@ -114,15 +272,13 @@ if __name__ == '__main__':
 
     pool = Pool()
 
-    print pool.map(make_exc, range(9))
-
-    import sys; sys.exit()
-
-    for i in range(9):
-        pool.apply_async(do_task, (i, ))
+    futures = [pool.apply_async(do_task, (i, )) for i in range(9)]
+    print [future.result() for future in as_completed(futures)]
 
-    pool.join()
+    print pool.map(do_task, range(9))
 
-    import sys; sys.exit()
+    pool.resize(1)
+    print pool.map(do_task, range(3))
 
-    print pool.map(do_task, range(9))
+    print pool.apply_async(make_exc, (0, )).exception()
+    print pool.map(make_exc, range(9))
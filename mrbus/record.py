@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# the compact records through the gov -> model pipeline
+#
+# a sweep holds ~1000 routes x 2 secs x ~50 stops of them at once, so they are
+# slotted classes and namedtuples instead of dicts; neither has a per-instance
+# __dict__.
+#
+#     $ python -m mrbus.record
+#
+
+from collections import namedtuple
+
+# a bus on the RouteInfo api
+#
+# bus_no: bn
+# floor: fl -> "h" means 一般公車, "l" means 低地板公車
+# io: io -> "i" means 進站中, "o" means 離站中
+Bus = namedtuple('Bus', 'idx bus_no floor io')
+
+def make_bus(d):
+    # d: a dict of the api's Buses
+    return Bus(d['idx'], d.get('bn'), d.get('fl'), d.get('io'))
+
+class _Record(object):
+
+    # a mutable record; the attrs not given are None
+
+    __slots__ = ()
+
+    def __init__(self, *args, **kargs):
+        for attr, val in zip(self.__slots__, args):
+            setattr(self, attr, val)
+        for attr in self.__slots__[len(args):]:
+            setattr(self, attr, kargs.pop(attr, None))
+        if kargs:
+            raise TypeError('unknown attrs: {}'.format(', '.join(kargs)))
+
+    def to_row(self, attrs=None):
+        if attrs is None:
+            attrs = self.__slots__
+        return [getattr(self, attr) for attr in attrs]
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, ', '.join(
+            '{}={!r}'.format(attr, getattr(self, attr))
+            for attr in self.__slots__
+        ))
+
+# a row of phi; the attrs are in the order of its columns
+class Phi(_Record):
+
+    __slots__ = (
+        'route_id',
+        'serial_no',
+        'it_is_return',
+        'idx',
+        'stop_id',
+        'status_code',
+        'waiting_min',
+        'interval_min',
+        'updated_ts',
+        'created_ts'
+    )
+
+# the eta columns of a row of phi
+class Eta(_Record):
+
+    __slots__ = (
+        'route_id',
+        'serial_no',
+        'status_code',
+        'waiting_min',
+        'interval_min',
+        'updated_ts'
+    )
+
+if __name__ == '__main__':
+
+    import sys
+
+    phi = Phi('tp_10723', 0, False, 1, 42, status_code=0, waiting_min=3)
+    print phi
+    print phi.to_row()
+    print Eta('tp_10723', 0, updated_ts=None).to_row(('route_id', 'serial_no'))
+    print make_bus({'idx': 1, 'bn': '123-FT', 'fl': 'l', 'io': 'i'})
+
+    pd = dict(zip(Phi.__slots__, phi.to_row()))
+    print 'Phi : {} bytes'.format(sys.getsizeof(phi))
+    print 'dict: {} bytes'.format(sys.getsizeof(pd))
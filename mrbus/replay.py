@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# a local stand-in of the gov sites, which replays the recorded responses
+#
+# it works as an http proxy, so the urls in mrbus.gov are kept as they are;
+# just point http_proxy to it:
+#
+#     $ python -m mrbus.replay serve fixtures/ --latency-sec=0.05 &
+#     $ http_proxy=http://127.0.0.1:8080 python -m mrbus.op sync_etas_of_all_routes
+#
+# record the fixtures from the live sites first:
+#
+#     $ python -m mrbus.replay record fixtures/
+#
+
+import os
+import socket
+from time import sleep
+from random import random, uniform
+from hashlib import md5
+from threading import Thread, Lock
+from urllib import urlencode
+from urlparse import urlparse, urlunparse, parse_qsl
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from mrbus.util import debug
+
+def _normalize_url(url):
+    # drop the cache buster, see _RoutePage._format_api_url
+    r = urlparse(url)
+    query = urlencode(sorted(
+        (k, v) for k, v in parse_qsl(r.query, keep_blank_values=True)
+        if k != '_'
+    ))
+    return urlunparse(r._replace(query=query))
+
+def _get_fixture_path(fixture_dir, url):
+    return os.path.join(
+        fixture_dir,
+        md5(_normalize_url(url)).hexdigest()+'.txt'
+    )
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+
+    # keep-alive as the real sites
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status_code, body):
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _reset(self):
+        # close without any response, as a connection reset
+        self.close_connection = True
+        self.connection.shutdown(socket.SHUT_RDWR)
+
+    def do_GET(self):
+
+        server = self.server
+        server.count('request_n')
+
+        latency_sec = server.latency_sec
+        if server.jitter_sec:
+            latency_sec += uniform(-server.jitter_sec, server.jitter_sec)
+        if latency_sec > 0:
+            sleep(latency_sec)
+
+        if random() < server.reset_rate:
+            server.count('reset_n')
+            self._reset()
+            return
+
+        if random() < server.error_rate:
+            server.count('error_n')
+            self._send(503, 'Service Unavailable')
+            return
+
+        path = _get_fixture_path(server.fixture_dir, self.path)
+
+        if server.is_recording and not os.path.exists(path):
+            server.record(self.path, path, self.headers.get('Referer'))
+
+        if not os.path.exists(path):
+            server.count('miss_n')
+            # as the gov sites do for the routes without return part
+            self._send(200, 'Not found')
+            return
+
+        with open(path, 'rb') as f:
+            body = f.read()
+
+        self._send(200, body)
+
+class ReplayServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        fixture_dir,
+        addr = ('127.0.0.1', 8080),
+        latency_sec = 0,
+        jitter_sec = 0,
+        error_rate = 0,
+        reset_rate = 0,
+        is_recording = False
+    ):
+
+        HTTPServer.__init__(self, addr, _ReplayHandler)
+
+        self.fixture_dir = fixture_dir
+        self.latency_sec = latency_sec
+        self.jitter_sec = jitter_sec
+        self.error_rate = error_rate
+        self.reset_rate = reset_rate
+        self.is_recording = is_recording
+
+        self._name_n_map = {}
+        self._lock = Lock()
+
+    def get_proxy_url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def count(self, name):
+        with self._lock:
+            self._name_n_map[name] = self._name_n_map.get(name, 0)+1
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._name_n_map)
+
+    def record(self, url, path, referer=None):
+
+        import requests
+        from mrbus.gov import _HEADERS
+
+        debug('record {}'.format(url))
+
+        headers = _HEADERS.copy()
+        if referer is not None:
+            headers['Referer'] = referer
+
+        session = requests.Session()
+        # don't go through ourself
+        session.trust_env = False
+
+        try:
+            resp = session.get(url, headers=headers, timeout=(3.05, 30))
+            resp.raise_for_status()
+        except IOError as e:
+            debug('{}: {}'.format(e.__class__.__name__, e))
+            return
+
+        with open(path, 'wb') as f:
+            f.write(resp.content)
+
+    def start(self):
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def serve(
+    fixture_dir, host='127.0.0.1', port=8080,
+    latency_sec=0.0, jitter_sec=0.0, error_rate=0.0, reset_rate=0.0,
+    is_recording=False
+):
+
+    server = ReplayServer(
+        fixture_dir,
+        addr = (host, port),
+        latency_sec = latency_sec,
+        jitter_sec = jitter_sec,
+        error_rate = error_rate,
+        reset_rate = reset_rate,
+        is_recording = is_recording
+    )
+
+    debug('serving on {}'.format(server.get_proxy_url()))
+    server.serve_forever()
+
+def record(fixture_dir, route_n=None):
+
+    # fetch the indexes, then the pages and apis of every route through a
+    # recording server
+
+    from mrbus.gov import (
+        TaipeiRouteIndex, NewTaipeiRouteIndex,
+        TaipeiRoutePage, NewTaipeiRoutePage
+    )
+
+    if not os.path.isdir(fixture_dir):
+        os.makedirs(fixture_dir)
+
+    server = ReplayServer(
+        fixture_dir,
+        addr = ('127.0.0.1', 0),
+        is_recording = True
+    ).start()
+    os.environ['http_proxy'] = server.get_proxy_url()
+
+    try:
+
+        ri_rpage_class_pairs = [
+            (TaipeiRouteIndex(), TaipeiRoutePage),
+            (NewTaipeiRouteIndex(), NewTaipeiRoutePage)
+        ]
+
+        for ri, rpage_class in ri_rpage_class_pairs:
+
+            rids = sorted(ri.get_name_rid_map().itervalues())
+            if route_n is not None:
+                rids = rids[:route_n]
+
+            for rid in rids:
+                for sec in (0, 1):
+                    rpage = rpage_class(rid, sec)
+                    rpage.get_idx_name_map()
+                    rpage.get_idx_eta_map()
+
+    finally:
+        del os.environ['http_proxy']
+        server.stop()
+
+    debug(server.get_stats())
+
+if __name__ == '__main__':
+
+    import clime
+    clime.start(debug=True)
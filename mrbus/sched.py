@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# a demand-driven scheduler of the eta refreshes
+#
+# instead of sweeping every route at the same pace, it keeps the routes in a
+# priority queue by their next refresh, and the interval of a route shrinks
+# with:
+#
+# 1. the demand: how often it's shown by query_plans in any process, see
+#    model.pop_route_demands,
+# 2. the running: any bus of it is running, not 未發車 or 已過末班,
+# 3. the change: how far the etas were from the expected ones last time.
+#
+#     $ python -m mrbus.sched run --duration-sec=3600
+#
+
+from math import exp, log
+from time import time, sleep
+from heapq import heappush, heappop
+from datetime import timedelta
+from mrbus.util import debug
+from mrbus import model, metrics
+
+# the diff of an eta from the expected one, which halves the interval
+_CHANGE_UNIT_MIN = 2.
+# the change when a route starts or stops running
+_FLIP_CHANGE_MIN = 5.
+
+class _RouteState(object):
+
+    def __init__(self, route_id, due_ts):
+
+        self.route_id = route_id
+        self.due_ts = due_ts
+        self.synced_ts = None
+
+        # assume running until we know, so it's refreshed soon
+        self.it_is_running = True
+        self.key_wmin_map = {}
+        self.change_min = 0.
+
+        # the decayed number of the plans showing it
+        self.demand = 0.
+        self.demand_ts = due_ts
+
+    def add_demand(self, n, now_ts, half_life_sec):
+        self.demand = self.get_demand(now_ts, half_life_sec)+n
+        self.demand_ts = now_ts
+
+    def get_demand(self, now_ts, half_life_sec):
+        return self.demand*exp(
+            -log(2)*(now_ts-self.demand_ts)/half_life_sec
+        )
+
+    def update(self, summary, now_ts):
+
+        it_is_running, key_wmin_map = summary
+
+        if self.synced_ts is not None and it_is_running != self.it_is_running:
+            self.change_min = _FLIP_CHANGE_MIN
+        elif self.synced_ts is not None:
+            # the etas should have counted down by the elapsed minutes
+            elapsed_min = (now_ts-self.synced_ts)/60.
+            diffs = [
+                abs(wmin-max(self.key_wmin_map[key]-elapsed_min, 0))
+                for key, wmin in key_wmin_map.iteritems()
+                if key in self.key_wmin_map
+            ]
+            if diffs:
+                self.change_min = sum(diffs)/len(diffs)
+            else:
+                self.change_min = 0.
+
+        self.it_is_running = it_is_running
+        self.key_wmin_map = key_wmin_map
+        self.synced_ts = now_ts
+
+class Scheduler(object):
+
+    # it isn't thread-safe; run it in one thread.
+    #
+    # running_interval_sec: the interval of a running route without demand
+    # idle_interval_sec: the interval of a not running one, also the max
+    # min_interval_sec: the min interval of the busiest routes
+
+    def __init__(
+        self,
+        pool = None,
+        batch_size = 100,
+        min_interval_sec = 30,
+        running_interval_sec = 300,
+        idle_interval_sec = 1800,
+        demand_half_life_sec = 600,
+        topology_ttl = timedelta(days=1)
+    ):
+
+        self._pool = pool
+        self._batch_size = batch_size
+        self._min_interval_sec = min_interval_sec
+        self._running_interval_sec = running_interval_sec
+        self._idle_interval_sec = idle_interval_sec
+        self._demand_half_life_sec = demand_half_life_sec
+        self._topology_ttl = topology_ttl
+
+        self._rid_state_map = {}
+        # (due_ts, route_id); an entry is stale if it mismatches the state
+        self._heap = []
+
+        metrics.register_gauge('mrbus_sched_route_n', self.get_route_n)
+        metrics.register_gauge('mrbus_sched_due_n', self.get_due_n)
+
+    def get_route_n(self):
+        return len(self._rid_state_map)
+
+    def get_due_n(self):
+        now_ts = time()
+        return sum(
+            1 for state in self._rid_state_map.itervalues()
+            if state.due_ts <= now_ts
+        )
+
+    def _push(self, state):
+        heappush(self._heap, (state.due_ts, state.route_id))
+
+    def reload_routes(self):
+
+        # add the new routes on index as due, and forget the gone ones
+
+        rid_set = set()
+        for rids in model._query_route_ids_it(1000):
+            rid_set.update(rids)
+
+        now_ts = time()
+        for rid in rid_set:
+            if rid not in self._rid_state_map:
+                state = self._rid_state_map[rid] = _RouteState(rid, now_ts)
+                self._push(state)
+
+        for rid in self._rid_state_map.keys():
+            if rid not in rid_set:
+                del self._rid_state_map[rid]
+
+        debug('{} routes'.format(len(self._rid_state_map)))
+
+    def _compute_interval_sec(self, state, now_ts):
+
+        if state.it_is_running:
+            sec = self._running_interval_sec
+        else:
+            sec = self._idle_interval_sec
+
+        sec /= 1.+state.get_demand(now_ts, self._demand_half_life_sec)
+        sec /= 1.+state.change_min/_CHANGE_UNIT_MIN
+
+        return min(max(sec, self._min_interval_sec), self._idle_interval_sec)
+
+    def _apply_demands(self, now_ts):
+
+        # pull the demanded routes forward
+
+        for rid, n in model.pop_route_demands().iteritems():
+
+            state = self._rid_state_map.get(rid)
+            if state is None:
+                continue
+
+            state.add_demand(n, now_ts, self._demand_half_life_sec)
+
+            if state.synced_ts is None:
+                continue
+
+            due_ts = max(
+                state.synced_ts+self._compute_interval_sec(state, now_ts),
+                now_ts
+            )
+            if due_ts < state.due_ts:
+                state.due_ts = due_ts
+                self._push(state)
+
+    def _pop_due_route_ids(self, now_ts):
+
+        rids = []
+
+        while self._heap and len(rids) < self._batch_size:
+
+            due_ts, rid = self._heap[0]
+            if due_ts > now_ts:
+                break
+            heappop(self._heap)
+
+            state = self._rid_state_map.get(rid)
+            if state is None or state.due_ts != due_ts:
+                continue
+
+            rids.append(rid)
+
+        return rids
+
+    def get_next_due_ts(self):
+
+        while self._heap:
+            due_ts, rid = self._heap[0]
+            state = self._rid_state_map.get(rid)
+            if state is not None and state.due_ts == due_ts:
+                return due_ts
+            heappop(self._heap)
+
+        return None
+
+    def run_once(self, budget_sec=None):
+
+        # refresh a batch of the due routes; returns the number of them
+
+        now_ts = time()
+        self._apply_demands(now_ts)
+
+        rids = self._pop_due_route_ids(now_ts)
+        if not rids:
+            return 0
+
+        rid_summary_map = model.sync_etas_of_routes(
+            rids,
+            pool = self._pool,
+            topology_ttl = self._topology_ttl,
+            budget_sec = budget_sec
+        )
+
+        now_ts = time()
+        for rid in rids:
+
+            state = self._rid_state_map[rid]
+
+            if rid not in rid_summary_map:
+                # failed to fetch or merge, try it again soon
+                state.due_ts = now_ts+self._min_interval_sec
+            elif rid_summary_map[rid] is None:
+                # unchanged, so nothing moves; just keep the pace
+                state.due_ts = now_ts+self._compute_interval_sec(
+                    state,
+                    now_ts
+                )
+            else:
+                summary = rid_summary_map[rid]
+                state.update(summary, now_ts)
+                state.due_ts = now_ts+self._compute_interval_sec(
+                    state,
+                    now_ts
+                )
+
+            self._push(state)
+
+        metrics.inc('mrbus_sched_refreshes_total', len(rids))
+        metrics.inc(
+            'mrbus_sched_failures_total',
+            len(rids)-len(rid_summary_map)
+        )
+
+        return len(rids)
+
+    def run(self, duration_sec=None, reload_routes_sec=3600):
+
+        start_ts = time()
+        reloaded_ts = None
+
+        while duration_sec is None or time()-start_ts < duration_sec:
+
+            if reloaded_ts is None or time()-reloaded_ts > reload_routes_sec:
+                self.reload_routes()
+                reloaded_ts = time()
+
+            if self.run_once():
+                continue
+
+            # nothing is due; the demands are checked every second
+            next_due_ts = self.get_next_due_ts()
+            if next_due_ts is None:
+                sleep(1)
+            else:
+                sleep(min(max(next_due_ts-time(), 0), 1))
+
+    def get_stats(self):
+
+        states = self._rid_state_map.values()
+        now_ts = time()
+
+        return {
+            'route_n'  : len(states),
+            'running_n': sum(1 for s in states if s.it_is_running),
+            'due_n'    : sum(1 for s in states if s.due_ts <= now_ts),
+            'demand'   : sum(
+                s.get_demand(now_ts, self._demand_half_life_sec)
+                for s in states
+            )
+        }
+
+def run(duration_sec=None, batch_size=100, min_interval_sec=30):
+    scheduler = Scheduler(
+        batch_size = batch_size,
+        min_interval_sec = min_interval_sec
+    )
+    scheduler.run(duration_sec)
+    debug(scheduler.get_stats())
+
+if __name__ == '__main__':
+
+    import clime
+    clime.start(debug=True)
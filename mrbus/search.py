@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# an in-process substring index of the stop names
+#
+# the names are short and mostly CJK, where a char is nearly a word, so it
+# indexes the unigrams and bigrams of chars; a keyword takes the postings of
+# its rarest gram, then each candidate is checked by `in`.
+
+from time import time
+from array import array
+from threading import Lock
+
+def iter_grams(s):
+    # unigrams and bigrams
+    for i in xrange(len(s)):
+        yield s[i]
+        if i+1 < len(s):
+            yield s[i:i+2]
+
+def _iter_keyword_grams(keyword):
+    # the bigrams cover the keyword if it has two chars or more
+    if len(keyword) == 1:
+        yield keyword
+    for i in xrange(len(keyword)-1):
+        yield keyword[i:i+2]
+
+def _rank_key(keyword, name):
+    # the prefix matches first, then the shorter, as the autocomplete wants
+    return (not name.startswith(keyword), len(name), name)
+
+class StopNameIndex(object):
+
+    def __init__(self):
+        self._lock = Lock()
+        self._sid_sname_map = {}
+        # gram -> array of stop ids
+        self._gram_sids_map = {}
+        self.loaded_ts = None
+
+    def is_loaded(self):
+        return self.loaded_ts is not None
+
+    def load(self, stop_rows):
+
+        # stop_rows: [(id, name), ...]
+
+        index = StopNameIndex()
+        index._add(stop_rows)
+
+        with self._lock:
+            self._sid_sname_map = index._sid_sname_map
+            self._gram_sids_map = index._gram_sids_map
+            self.loaded_ts = time()
+
+    def add(self, stop_rows):
+        # the stop names never change, so the known ids are skipped
+        with self._lock:
+            self._add(stop_rows)
+
+    def _add(self, stop_rows):
+
+        for sid, sname in stop_rows:
+
+            if sid in self._sid_sname_map:
+                continue
+            self._sid_sname_map[sid] = sname
+
+            for gram in set(iter_grams(sname)):
+                sids = self._gram_sids_map.get(gram)
+                if sids is None:
+                    sids = self._gram_sids_map[gram] = array('i')
+                sids.append(sid)
+
+    def search(self, keyword, limit=None):
+
+        # -> [{'id': ..., 'name': ...}, ...], as mrbus.model.query_stops
+
+        with self._lock:
+
+            if not keyword:
+                candidate_sids = self._sid_sname_map.keys()
+            else:
+                candidate_sids = min(
+                    (
+                        self._gram_sids_map.get(gram, ())
+                        for gram in _iter_keyword_grams(keyword)
+                    ),
+                    key = len
+                )
+
+            sid_sname_map = self._sid_sname_map
+            pairs = [
+                (sid, sid_sname_map[sid])
+                for sid in candidate_sids
+                if keyword in sid_sname_map[sid]
+            ]
+
+        pairs.sort(key=lambda pair: _rank_key(keyword, pair[1]))
+        if limit is not None:
+            pairs = pairs[:limit]
+
+        return [{'id': sid, 'name': sname} for sid, sname in pairs]
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'stop_n'   : len(self._sid_sname_map),
+                'gram_n'   : len(self._gram_sids_map),
+                'loaded_ts': self.loaded_ts
+            }
+
+if __name__ == '__main__':
+
+    import uniout
+    from pprint import pprint
+
+    index = StopNameIndex()
+    index.load([
+        (1, u'西門'),
+        (2, u'捷運西門站'),
+        (3, u'西門國小'),
+        (4, u'台電大樓'),
+    ])
+    index.add([(5, u'西')])
+
+    pprint(index.search(u'西門'))
+    pprint(index.search(u'西', limit=2))
+    pprint(index.search(u'電大'))
+    pprint(index.get_stats())
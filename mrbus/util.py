@@ -1,14 +1,20 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import sys
-import inspect
+from cStringIO import StringIO
 from datetime import datetime
 
+# MRBUS_DEBUG=0 to turn it off; see mrbus.metrics for the numbers
+is_debugging = os.environ.get('MRBUS_DEBUG', '1') != '0'
+
 def debug(s):
+    if not is_debugging:
+        return
     print >> sys.stderr, \
         'debug:', \
-        '{}:'.format(inspect.currentframe().f_back.f_code.co_name), \
+        '{}:'.format(sys._getframe(1).f_code.co_name), \
         s
 
 def get_now_dt():
@@ -29,3 +35,37 @@ def ensure_unicode(x, encoding='utf-8'):
 def escape_like_operand(s):
     # TODO: shall use mosql's once mosql has it
     return ensure_unicode(s).replace('\\', '\\\\').replace('_', '\_').replace('%', '\%')
+
+def _format_copy_value(x):
+
+    # the text format of COPY
+    # ref: http://www.postgresql.org/docs/9.5/static/sql-copy.html
+
+    if x is None:
+        return u'\\N'
+    if x is True:
+        return u't'
+    if x is False:
+        return u'f'
+    if isinstance(x, datetime):
+        return x.isoformat().decode('ascii')
+
+    return (
+        ensure_unicode(x)
+        .replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r')
+    )
+
+def copy_rows(cur, table, columns, rows):
+
+    f = StringIO()
+    for row in rows:
+        f.write(
+            u'\t'.join(_format_copy_value(x) for x in row).encode('utf-8')
+        )
+        f.write('\n')
+    f.seek(0)
+
+    cur.copy_from(f, table, columns=columns)
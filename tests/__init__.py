@@ -0,0 +1,3 @@
+# the unit tests without db or network
+#
+#     $ python -m unittest discover -s tests -t .
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+from mrbus.cache import LRUCache
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_evicts_the_least_recent(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.get_stats()['eviction_n'], 1)
+
+    def test_expires_after_ttl(self):
+        cache = LRUCache(10, ttl=-1)
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidates_by_any_tag(self):
+        cache = LRUCache(10)
+        cache.put('a', 1, [('stop', 1), ('route', 'x')])
+        cache.put('b', 2, [('stop', 2)])
+        cache.put('c', 3)
+        self.assertEqual(cache.invalidate([('route', 'x'), ('stop', 3)]), 1)
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_put_again_drops_the_old_tags(self):
+        cache = LRUCache(10)
+        cache.put('a', 1, [('stop', 1)])
+        cache.put('a', 2, [('stop', 2)])
+        self.assertEqual(cache.invalidate([('stop', 1)]), 0)
+        self.assertEqual(cache.get('a'), 2)
+        self.assertEqual(cache.invalidate([('stop', 2)]), 1)
+
+    def test_an_evicted_entry_is_untagged(self):
+        cache = LRUCache(1)
+        cache.put('a', 1, [('stop', 1)])
+        cache.put('b', 2)
+        self.assertEqual(cache.invalidate([('stop', 1)]), 0)
+        self.assertEqual(cache._tag_keys_map, {})
+
+    def test_an_expired_entry_is_untagged(self):
+        cache = LRUCache(10, ttl=-1)
+        cache.put('a', 1, [('stop', 1)])
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache._tag_keys_map, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+from mrbus.graph import PhiIndex
+
+class PhiIndexTest(unittest.TestCase):
+
+    # tp_1: A -> B -> C, tp_2: C -> D, tp_3: B -> D, tp_4: D -> E
+
+    def setUp(self):
+        self.index = PhiIndex()
+        self.index.load(
+            [('tp_1', u'1'), ('tp_2', u'2'), ('tp_3', u'3'), ('tp_4', u'4')],
+            [(1, u'A'), (2, u'B'), (3, u'C'), (4, u'D'), (5, u'E')],
+            [
+                ('tp_1', 0, False, 1, None),
+                ('tp_1', 1, False, 2, 2),
+                ('tp_1', 2, False, 3, 2),
+                ('tp_2', 0, False, 3, None),
+                ('tp_2', 1, False, 4, 1),
+                ('tp_3', 0, False, 2, None),
+                ('tp_3', 1, False, 4, 10),
+                ('tp_4', 0, False, 4, None),
+                ('tp_4', 1, False, 5, 3),
+            ]
+        )
+
+    def _summarize_direct(self, plan_ds):
+        return [
+            (
+                plan_d['route_id'],
+                plan_d['orig_stop_id'],
+                plan_d['dest_stop_id'],
+                plan_d['dest_phi_serial_no']
+            )
+            for plan_d in plan_ds
+        ]
+
+    def test_direct(self):
+        self.assertEqual(
+            self._summarize_direct(self.index.find_direct([2], [4])),
+            [('tp_3', 2, 4, 1)]
+        )
+
+    def test_direct_only_forward(self):
+        self.assertEqual(self.index.find_direct([3], [1]), [])
+
+    def test_direct_by_any_of_the_stops(self):
+        self.assertEqual(
+            self._summarize_direct(self.index.find_direct([1, 3], [4])),
+            [('tp_2', 3, 4, 1)]
+        )
+
+    def test_patch_moves_the_postings(self):
+        self.index.patch([], [('tp_2', 1, False, 5, 1)])
+        self.assertEqual(self.index.find_direct([3], [4]), [])
+        self.assertEqual(
+            self._summarize_direct(self.index.find_direct([3], [5])),
+            [('tp_2', 3, 5, 1)]
+        )
+
+    def _summarize(self, plan_ds):
+        return [
+            (
+                plan_d['total_min'],
+                tuple(leg_d['route_id'] for leg_d in plan_d['legs'])
+            )
+            for plan_d in plan_ds
+        ]
+
+    def test_one_transfer_ranked_by_driving_min(self):
+        self.assertEqual(
+            self._summarize(self.index.find_plans([1], [4])),
+            [(5., ('tp_1', 'tp_2')), (12., ('tp_1', 'tp_3'))]
+        )
+
+    def test_legs(self):
+        leg_ds = self.index.find_plans([1], [4], limit=1)[0]['legs']
+        self.assertEqual(
+            [
+                (
+                    leg_d['orig_stop_id'],
+                    leg_d['dest_stop_id'],
+                    leg_d['driving_min']
+                )
+                for leg_d in leg_ds
+            ],
+            [(1, 3, 4.), (3, 4, 1.)]
+        )
+
+    def test_two_transfers_only_if_asked(self):
+        self.assertEqual(self.index.find_plans([1], [5]), [])
+        self.assertEqual(
+            self._summarize(self.index.find_plans([1], [5], max_transfer_n=2)),
+            [(8., ('tp_1', 'tp_2', 'tp_4')), (15., ('tp_1', 'tp_3', 'tp_4'))]
+        )
+
+    def test_limit(self):
+        self.assertEqual(len(self.index.find_plans([1], [4], limit=1)), 1)
+
+    def test_patch_removes_a_shortened_tail(self):
+        self.index.patch([], [], removed_phi_rows=[('tp_2', 1, 4)])
+        self.assertEqual(
+            self._summarize(self.index.find_plans([1], [4])),
+            [(12., ('tp_1', 'tp_3'))]
+        )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+from time import sleep
+from mrbus import lease
+
+class WorkOnceTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.leased_rids = ['a', 'b', 'c']
+        self.held_rids = None
+        self.synced_rids = []
+        self.sync_sec = 0
+        self.sync_exc = None
+        self.calls = []
+
+        self._orig_attr_val_map = {}
+        for attr in ('lease', 'renew', '_sync', 'complete', 'release'):
+            self._orig_attr_val_map[attr] = getattr(lease, attr)
+            setattr(lease, attr, getattr(self, '_fake_'+attr))
+
+    def tearDown(self):
+        for attr, val in self._orig_attr_val_map.iteritems():
+            setattr(lease, attr, val)
+
+    def _fake_lease(self, sweep, worker, batch_size, lease_sec):
+        return list(self.leased_rids)
+
+    def _fake_renew(self, sweep, worker, route_ids, lease_sec):
+        if self.held_rids is None:
+            return list(route_ids)
+        if isinstance(self.held_rids, Exception):
+            raise self.held_rids
+        return [rid for rid in route_ids if rid in self.held_rids]
+
+    def _fake__sync(self, sweep, route_ids, pool, budget_sec):
+        sleep(self.sync_sec)
+        if self.sync_exc is not None:
+            raise self.sync_exc
+        return list(self.synced_rids)
+
+    def _fake_complete(self, sweep, worker, route_ids, interval_sec):
+        self.calls.append(('complete', route_ids))
+
+    def _fake_release(self, sweep, worker, route_ids, retry_sec):
+        self.calls.append(('release', route_ids))
+
+    def test_nothing_due(self):
+        self.leased_rids = []
+        self.assertEqual(lease.work_once('etas', 'w'), 0)
+        self.assertEqual(self.calls, [])
+
+    def test_completes_the_synced_and_releases_the_others(self):
+        self.synced_rids = ['a', 'c']
+        self.assertEqual(lease.work_once('etas', 'w'), 3)
+        self.assertEqual(
+            self.calls,
+            [('complete', ['a', 'c']), ('release', ['b'])]
+        )
+
+    def test_a_failed_sync_releases_all(self):
+        self.sync_exc = ValueError('boom')
+        self.assertEqual(lease.work_once('etas', 'w'), 3)
+        self.assertEqual(
+            self.calls,
+            [('complete', []), ('release', ['a', 'b', 'c'])]
+        )
+
+    def test_leaves_the_lost_leases(self):
+        self.synced_rids = ['a', 'b']
+        self.held_rids = ['a', 'c']
+        self.sync_sec = 0.1
+        lease.work_once('etas', 'w', lease_sec=0.03)
+        self.assertEqual(
+            self.calls,
+            [('complete', ['a']), ('release', ['c'])]
+        )
+
+    def test_a_failed_renewal_keeps_the_leases(self):
+        self.synced_rids = ['a', 'b', 'c']
+        self.held_rids = IOError('db is down')
+        self.sync_sec = 0.1
+        lease.work_once('etas', 'w', lease_sec=0.03)
+        self.assertEqual(
+            self.calls,
+            [('complete', ['a', 'b', 'c']), ('release', [])]
+        )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+from mrbus import model
+
+class _FakeRoutePage(object):
+
+    def __init__(self, idx_name_map, idx_eta_map, page_hash='p', api_hash='a'):
+        self._idx_name_map = idx_name_map
+        self._idx_eta_map = idx_eta_map
+        self.page_hash = page_hash
+        self.api_hash = api_hash
+
+    def get_idx_name_map(self):
+        return self._idx_name_map
+
+    def get_idx_eta_map(self):
+        return self._idx_eta_map
+
+class BuildPhisTest(unittest.TestCase):
+
+    def test_serial_nos_run_across_the_secs(self):
+
+        rpagep = (
+            _FakeRoutePage({2: u'B', 1: u'A'}, {1: 3, 2: 255}),
+            _FakeRoutePage({1: u'C'}, {1: 5})
+        )
+        phis, raw_etas = model._build_phis(
+            'tp_1', rpagep, {u'A': 10, u'B': 20, u'C': 30}
+        )
+
+        self.assertEqual(
+            [
+                (phi.serial_no, phi.it_is_return, phi.idx, phi.stop_id)
+                for phi in phis
+            ],
+            [(0, False, 1, 10), (1, False, 2, 20), (2, True, 1, 30)]
+        )
+        self.assertEqual(raw_etas, [3, 255, 5])
+
+class IsCompleteTest(unittest.TestCase):
+
+    def test_complete(self):
+        rpagep = (
+            _FakeRoutePage({1: u'A'}, {1: 3}),
+            _FakeRoutePage({}, {})
+        )
+        self.assertTrue(model._is_complete(rpagep))
+
+    def test_a_stop_without_eta(self):
+        rpagep = (
+            _FakeRoutePage({1: u'A', 2: u'B'}, {1: 3}),
+            _FakeRoutePage({}, {})
+        )
+        self.assertFalse(model._is_complete(rpagep))
+
+    def test_a_failed_page(self):
+        # no stop on it, but it's not fetched
+        rpagep = (
+            _FakeRoutePage({1: u'A'}, {1: 3}),
+            _FakeRoutePage({}, {}, page_hash=None)
+        )
+        self.assertFalse(model._is_complete(rpagep))
+
+    def test_a_failed_api(self):
+        rpagep = (
+            _FakeRoutePage({1: u'A'}, {1: 3}, api_hash=None),
+            _FakeRoutePage({}, {})
+        )
+        self.assertFalse(model._is_complete(rpagep))
+
+if __name__ == '__main__':
+    unittest.main()
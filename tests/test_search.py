@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+from mrbus.search import StopNameIndex
+
+class StopNameIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = StopNameIndex()
+        self.index.load([
+            (1, u'西門'),
+            (2, u'捷運西門站'),
+            (3, u'西門國小'),
+            (4, u'台電大樓'),
+        ])
+
+    def _search_ids(self, keyword, limit=None):
+        return [d['id'] for d in self.index.search(keyword, limit)]
+
+    def test_prefix_first_then_shorter(self):
+        self.assertEqual(self._search_ids(u'西門'), [1, 3, 2])
+
+    def test_single_char(self):
+        self.assertEqual(self._search_ids(u'西', limit=2), [1, 3])
+
+    def test_infix(self):
+        self.assertEqual(self._search_ids(u'電大'), [4])
+
+    def test_no_match(self):
+        # each gram exists, but not the keyword
+        self.assertEqual(self._search_ids(u'門台'), [])
+        self.assertEqual(self._search_ids(u'東門'), [])
+
+    def test_add_skips_the_known_ids(self):
+        self.index.add([(1, u'東門'), (5, u'西')])
+        self.assertEqual(self._search_ids(u'東'), [])
+        self.assertEqual(self._search_ids(u'西')[0], 5)
+
+    def test_empty_keyword_takes_all(self):
+        self.assertEqual(len(self.index.search(u'')), 4)
+
+if __name__ == '__main__':
+    unittest.main()